@@ -3,8 +3,34 @@
 # lurklite: A "lightweight™" version of lurk.
 #
 
-import argparse, configparser, miniirc, sys
+import time
+_started = time.perf_counter()
+
+import argparse, configparser, miniirc, signal, sys, threading
 import lurklite.core as core
+_import_time = time.perf_counter() - _started
+
+def _reload(bot):
+    try:
+        added, removed = bot.reload_config()
+    except Exception as e:
+        print(f'ERROR: Failed to reload the config file: {e}',
+              file=sys.stderr)
+    else:
+        print(f'Reloaded the config file, added {added} and removed '
+              f'{removed}.')
+
+# Print the time taken by each phase of startup
+def _print_startup_profile(bot, config_time, connected, ready):
+    print('Startup profile:')
+    phases = [('imports', _import_time, False), ('config', config_time, False),
+              *bot.startup_profile]
+    for name, elapsed, background in phases:
+        if background:
+            name += ' (background)'
+        print(f'  {name:<32} {elapsed * 1000:8.1f}ms')
+    print(f'Connected after {connected * 1000:.1f}ms, ready to handle '
+          f'messages after {ready * 1000:.1f}ms.')
 
 # Process arguments
 def main():
@@ -15,19 +41,35 @@ def main():
         help='Enable verbose/debugging mode.')
     parser.add_argument('-v', '--version', action='version',
         version=miniirc.version)
+    parser.add_argument('--startup-profile', action='store_true',
+        help='Print how long each phase of startup takes.')
     args = parser.parse_args()
 
     # Load the config file
+    start = time.perf_counter()
     config = configparser.ConfigParser()
     config.read(args.config_file)
+    config_time = time.perf_counter() - start
 
     # Create the bot
     try:
-        bot = core.Bot(config, debug=args.verbose)
+        bot = core.Bot(config, debug=args.verbose,
+                       config_file=args.config_file)
     except core.BotError as e:
         print(f'ERROR: {e}', file=sys.stderr)
         raise SystemExit(1)
 
+    if args.startup_profile:
+        connected = time.perf_counter() - _started
+        bot.wait_until_ready()
+        _print_startup_profile(bot, config_time, connected,
+                               time.perf_counter() - _started)
+
+    # Reload the config file on SIGHUP
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame : threading.Thread(
+            target=_reload, args=(bot,)).start())
+
     bot.wait_until_disconnected()
 
 # Call main() if required.
@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+#
+# Admission control - A thread pool that runs high priority work first and
+#   sheds stale or excess low priority work when the bot is overloaded.
+#
+
+import collections, concurrent.futures, heapq, itertools, threading, time, \
+    traceback
+
+# Priorities, lower numbers run first.
+HIGH   = 0
+NORMAL = 1
+LOW    = 2
+
+# A replacement for concurrent.futures.ThreadPoolExecutor (only submit() is
+#   implemented). classify(fn, args) should return a (priority, key) tuple,
+#   when the executor is overloaded low priority work with the same key as
+#   pending work is coalesced.
+class AdmissionExecutor:
+    def __init__(self, max_workers=32, *, classify=None, max_queue=256,
+            max_latency=30):
+        self.max_workers = max_workers
+        self.max_queue   = max_queue
+        self.max_latency = max_latency
+        self.stats       = collections.Counter()
+        self._classify   = classify
+        self._heap       = []
+        self._keys       = collections.Counter()
+        self._wait       = 0
+        self._counter    = itertools.count()
+        self._cond       = threading.Condition()
+        self._workers    = 0
+        self._idle       = 0
+
+    def __repr__(self):
+        return (f'<admission.AdmissionExecutor with {len(self._heap)} '
+                f'pending item(s)>')
+
+    # Get the number of pending items
+    @property
+    def depth(self):
+        return len(self._heap)
+
+    # Check if the executor is overloaded, which is when half of max_queue
+    #   is used or work waited for more than half of max_latency before it
+    #   was started. This must be called with the lock held.
+    def _overloaded(self):
+        return len(self._heap) >= self.max_queue / 2 or \
+            self._wait > self.max_latency / 2
+
+    def _shed(self, future, reason):
+        self.stats[reason] += 1
+        future.cancel()
+        future.set_running_or_notify_cancel()
+        return future
+
+    def submit(self, fn, *args, **kwargs):
+        priority, key = HIGH, None
+        if self._classify:
+            # This is usually called from receive threads, so errors must not
+            #   be raised here.
+            try:
+                priority, key = self._classify(getattr(fn, '__wrapped__', fn),
+                                               args)
+            except Exception:
+                print('WARNING: Unable to classify', repr(fn) + '!')
+                traceback.print_exc()
+                priority, key = LOW, None
+
+        future = concurrent.futures.Future()
+        with self._cond:
+            depth = len(self._heap)
+            if priority >= LOW:
+                if depth >= self.max_queue:
+                    return self._shed(future, 'shed_queue')
+                if key is not None:
+                    if self._keys[key] and self._overloaded():
+                        return self._shed(future, 'coalesced')
+                    self._keys[key] += 1
+            elif priority == NORMAL and depth >= self.max_queue * 2:
+                return self._shed(future, 'shed_queue')
+
+            heapq.heappush(self._heap, (priority, next(self._counter),
+                time.monotonic(), key, future, fn, args, kwargs))
+
+            # Idle workers are claimed here rather than when they wake up, so
+            #   that bursts start new workers instead of waking the same one.
+            if self._idle:
+                self._idle -= 1
+                self._cond.notify()
+            elif self._workers < self.max_workers:
+                self._workers += 1
+                threading.Thread(target=self._worker, daemon=True,
+                                 name='lurklite-worker').start()
+
+        return future
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._wait = 0
+                    self._idle += 1
+                    self._cond.wait()
+
+                priority, _, queued, key, future, fn, args, kwargs = \
+                    heapq.heappop(self._heap)
+                if key is not None:
+                    self._keys[key] -= 1
+                    if not self._keys[key]:
+                        del self._keys[key]
+
+                # Drop stale low priority work
+                self._wait = time.monotonic() - queued
+                if priority >= LOW and self._wait > self.max_latency:
+                    self._shed(future, 'shed_stale')
+                    continue
+
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                res = fn(*args, **kwargs)
+            except BaseException as exc:
+                future.set_exception(exc)
+            else:
+                future.set_result(res)
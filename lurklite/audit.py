@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+#
+# Audit log - Records dispatched commands, tempcmd changes and errors
+#
+
+import argparse, collections, datetime, json, os, queue, sys, threading, time
+
+# Try importing msgpack
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Records are stored as lists to keep the log compact.
+FIELDS = ('time', 'event', 'network', 'channel', 'user', 'command', 'detail')
+
+# The audit log, records are written in batches by a background thread.
+class AuditLog:
+    def __init__(self, location, *, max_size=10485760, backups=5,
+            use_json=False):
+        self.location = location
+        self.max_size = max_size
+        self.backups  = backups
+        self.use_json = use_json or not msgpack
+        self._queue   = queue.SimpleQueue()
+        self._thread  = threading.Thread(target=self._main,
+                                         name='lurklite-audit', daemon=True)
+        self._thread.start()
+
+    def __repr__(self):
+        return 'audit.AuditLog(' + repr(self.location) + ')'
+
+    # Add a record, this does not block.
+    def record(self, event, network, channel, user, command, detail=None):
+        self._queue.put([time.time(), event, network, channel, user, command,
+                         detail])
+
+    # Flush any pending records and stop the writer thread
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _encode(self, records):
+        if self.use_json:
+            return ''.join(json.dumps(record, separators=(',', ':')) + '\n'
+                           for record in records).encode('utf-8')
+        return b''.join(map(msgpack.dumps, records))
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            src = f'{self.location}.{i}'
+            if os.path.exists(src):
+                os.replace(src, f'{self.location}.{i + 1}')
+
+        if self.backups > 0:
+            os.replace(self.location, self.location + '.1')
+        else:
+            os.remove(self.location)
+
+    # The writer thread
+    def _main(self):
+        f = None
+        running = True
+        while running:
+            records = [self._queue.get()]
+            while len(records) < 1024:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in records:
+                running = False
+                records = [record for record in records if record is not None]
+                if not records:
+                    break
+
+            try:
+                if f is None:
+                    f = open(self.location, 'ab')
+                f.write(self._encode(records))
+                f.flush()
+
+                if f.tell() >= self.max_size:
+                    f.close()
+                    f = None
+                    self._rotate()
+            except OSError as e:
+                print('WARNING: Unable to write to the audit log!', repr(e))
+                if f is not None:
+                    f.close()
+                    f = None
+
+        if f is not None:
+            f.close()
+
+# Read records from a single file
+def _read_file(location):
+    with open(location, 'rb') as f:
+        if f.peek(1)[:1] == b'[':
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        elif msgpack:
+            yield from msgpack.Unpacker(f, raw=False)
+        else:
+            raise ImportError('msgpack is required to read this audit log!')
+
+# Read records from the log and any rotated backups, oldest first
+def read_records(location):
+    files = [location]
+    i = 1
+    while os.path.exists(f'{location}.{i}'):
+        files.append(f'{location}.{i}')
+        i += 1
+
+    for location in reversed(files):
+        if os.path.exists(location):
+            yield from _read_file(location)
+
+# Filter records
+def query(records, *, since=None, until=None, **filters):
+    indexes = [(FIELDS.index(k), v) for k, v in filters.items()
+               if v is not None]
+    for record in records:
+        if since is not None and record[0] < since:
+            continue
+        if until is not None and record[0] >= until:
+            continue
+        if all(record[i] == v for i, v in indexes):
+            yield record
+
+# Count records by one or more fields
+def aggregate(records, *fields):
+    indexes = [FIELDS.index(field) for field in fields]
+    return collections.Counter(tuple(record[i] for i in indexes)
+                               for record in records)
+
+# Parse a timestamp from the command line
+def _parse_time(value):
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+def _format_record(record):
+    timestamp = datetime.datetime.fromtimestamp(record[0])
+    return ' '.join((timestamp.isoformat(' ', 'seconds'),
+                     *(repr(field) for field in record[1:])))
+
+# The query CLI
+def main():
+    parser = argparse.ArgumentParser(prog='python3 -m lurklite.audit',
+        description='Query the lurklite audit log.')
+    parser.add_argument('file', help='The audit log file.')
+    for field in FIELDS[1:-1]:
+        parser.add_argument('--' + field, help=f'Only show this {field}.')
+    parser.add_argument('--since', type=_parse_time,
+        help='Only show records from this time (ISO 8601 or UNIX time).')
+    parser.add_argument('--until', type=_parse_time,
+        help='Only show records before this time (ISO 8601 or UNIX time).')
+    parser.add_argument('--group-by', action='append',
+        choices=FIELDS[1:-1], help='Count records by this field. This may be '
+        'specified more than once.')
+    parser.add_argument('--limit', type=int,
+        help='The maximum number of results to display.')
+    args = parser.parse_args()
+
+    filters = {field: getattr(args, field) for field in FIELDS[1:-1]}
+    records = query(read_records(args.file), since=args.since,
+                    until=args.until, **filters)
+
+    try:
+        if args.group_by:
+            counts = aggregate(records, *args.group_by)
+            for key, count in counts.most_common(args.limit):
+                print(count, *(repr(field) for field in key), sep='\t')
+        else:
+            for i, record in enumerate(records):
+                if args.limit is not None and i >= args.limit:
+                    break
+                print(_format_record(record))
+    except BrokenPipeError:
+        sys.stderr.close()
+
+if __name__ == '__main__':
+    main()
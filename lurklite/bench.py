@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+#
+# Microbenchmarks - Compares the single pass message triage and command type
+#   guessing with the step by step versions they replaced.
+#
+
+import argparse, timeit
+import lurklite.core as core, lurklite.static_cmds as static_cmds, \
+    lurklite.tempcmds as tempcmds
+
+core.static_cmds = static_cmds
+
+# The old way of sorting messages (from Bot.handle_privmsg())
+def _legacy_triage(prefs, nick, msg):
+    reply_prefix = ''
+    if msg.startswith('[off]'):
+        reply_prefix = '[off] '
+        msg = msg[5:]
+
+    relay = None
+    if msg.startswith('<'):
+        n = msg.split(' ', 1)
+        if n[0].endswith('>') and len(n) > 1 and msg[1].isalnum():
+            relay = n[0][1:-1]
+            msg = n[1]
+
+    text = msg = msg.strip(' \t\r\n')
+    msg = msg.lower()
+
+    if not prefs['disable_yay'] and msg.startswith('yay'):
+        kind, cmd = core.REPLY, None
+    elif not prefs['disable_ouch'] and msg.startswith('ouch'):
+        kind, cmd = core.REPLY, None
+    elif msg.startswith(nick.lower() + '!'):
+        kind, cmd = core.REPLY, None
+    elif msg.startswith(prefs['prefix']):
+        cmd = msg[len(prefs['prefix']):].split(' ', 1)[0]
+        if prefs['static_cmds'] and cmd in static_cmds.commands:
+            kind = core.STATIC
+        else:
+            kind = core.TEMPCMD
+    else:
+        kind, cmd = core.IGNORE, None
+
+    return kind, reply_prefix, relay, text, cmd
+
+# Convert results to the same format as _legacy_triage(), commands are the
+#   only messages that need the text.
+def _compare(legacy, new):
+    kind, match, text, cmd = new
+    if kind in (core.STATIC, core.TEMPCMD):
+        return legacy == (kind, '[off] ' if match['off'] else '',
+                          match['relay'], text, cmd)
+    return legacy[0] == kind
+
+# The old way of guessing command types (from tempcmds.Command.__init__())
+def _legacy_guess(code):
+    for regex, type_ in tempcmds._unknown_regex:
+        if regex.match(code):
+            return type_
+    return None
+
+MESSAGES = (
+    'hello everyone, how is it going?',
+    'Has anyone tried the new release yet? It looks good',
+    '.version',
+    '.tempcmd list',
+    '.hello world',
+    '.some_tempcmd with a few arguments',
+    '[off] .hello',
+    '<relayed_user> .hello there',
+    '<relayed_user> just chatting through a relay',
+    '<> not relayed',
+    '  .hello  ',
+    'YAY it works',
+    'ouch',
+    'lurklite!',
+    'LurkLite! hello',
+    'a' * 400,
+)
+
+CODES = (
+    'Hello {nick}!',
+    '*waves at {args}*',
+    '.alias',
+    'https://example.com/?q={args}',
+    'lambda *args: " ".join(args)',
+    'function(a) { return a; }',
+    'just some text that is not any special type ' * 4,
+)
+
+def _bench(name, legacy, new, items, number):
+    def run(func):
+        return min(timeit.repeat(lambda : [func(*item) for item in items],
+                                 number=number, repeat=5))
+
+    old_time = run(legacy) / (number * len(items))
+    new_time = run(new) / (number * len(items))
+    print(f'{name:<20} old {old_time * 1e9:8.0f}ns, new '
+          f'{new_time * 1e9:8.0f}ns per call '
+          f'({old_time / new_time:.2f}x faster)')
+
+def main():
+    parser = argparse.ArgumentParser(prog='python3 -m lurklite.bench',
+        description='Compare message triage and command type guessing with '
+                    'the old implementations.')
+    parser.add_argument('--recording',
+        help='Use PRIVMSGs from a traffic recording (see lurklite.traffic).')
+    parser.add_argument('--prefix', default='.',
+        help='The command prefix to use.')
+    parser.add_argument('--number', type=int, default=2000,
+        help='The number of times to run each benchmark.')
+    args = parser.parse_args()
+
+    messages = MESSAGES
+    if args.recording:
+        import lurklite.traffic as traffic
+        messages = [event_args[-1] for _, _, event, _, event_args in
+                    traffic.read_recording(args.recording)
+                    if event == 'PRIVMSG' and event_args]
+
+    prefs = {'prefix': args.prefix, 'static_cmds': True,
+             'disable_yay': False, 'disable_ouch': False}
+    prefs['triage'] = {}
+    items = [(prefs, 'lurklite', msg) for msg in messages]
+
+    # Make sure that both versions agree before timing them
+    for item in items:
+        if not _compare(_legacy_triage(*item), core.triage(*item)):
+            print(f'WARNING: Triage results differ for {item[-1]!r}: '
+                  f'{_legacy_triage(*item)!r} != {core.triage(*item)!r}')
+    for code in CODES:
+        if _legacy_guess(code) != tempcmds.guess_command_type(code):
+            print(f'WARNING: Type guesses differ for {code!r}.')
+
+    print(f'{len(items)} message(s), {len(CODES)} command(s):')
+    _bench('Message triage', _legacy_triage, core.triage, items, args.number)
+    for kind, name in ((core.IGNORE, 'ignored'), (core.REPLY, 'replies'),
+                       (core.STATIC, 'static'), (core.TEMPCMD, 'tempcmds')):
+        kind_items = [item for item in items
+                      if _legacy_triage(*item)[0] == kind]
+        if kind_items:
+            _bench(f'  {name} ({len(kind_items)})', _legacy_triage,
+                   core.triage, kind_items, args.number)
+    _bench('Type guessing', _legacy_guess, tempcmds.guess_command_type,
+           [(code,) for code in CODES], args.number * 10)
+
+if __name__ == '__main__':
+    main()
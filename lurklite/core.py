@@ -3,9 +3,13 @@
 # lurklite core
 #
 
-import concurrent.futures, miniirc, re, time
-import lurklite.tempcmds as tempcmds
+import configparser, contextlib, miniirc, re, threading, time, traceback
+import lurklite.admission as admission, lurklite.inflight as inflight, \
+    lurklite.scheduler as scheduler, lurklite.tempcmds as tempcmds
+audit = None
+replication = None
 static_cmds = None
+traffic = None
 
 # The version
 miniirc.version = f'lurklite v0.4.27 (powered by {miniirc.version})'
@@ -19,6 +23,70 @@ def err(msg, *args, **kwargs):
         msg = msg.format(*args, **kwargs)
     raise BotError(msg)
 
+# Message kinds (see triage())
+IGNORE  = 0
+REPLY   = 1
+STATIC  = 2
+TEMPCMD = 3
+
+# Compile the RegEx used by triage() for a connection's preferences and nick.
+#   This handles [off], relayed nicks, leading whitespace, yay/ouch, "nick!"
+#   and the prefix in one pass. Also returns the (lowercase) characters that
+#   messages which aren't ignored can start with, or None if any character
+#   can.
+def compile_triage(prefs, nick):
+    parts = []
+    starts = {'[', '<', ' ', '\t', '\r', '\n', nick[:1].lower(),
+              prefs['prefix'][:1].lower()}
+    if not prefs['disable_yay']:
+        parts.append('(?P<yay>(?i:yay))')
+        starts.add('y')
+    if not prefs['disable_ouch']:
+        parts.append('(?P<ouch>(?i:ouch))')
+        starts.add('o')
+    parts.append('(?P<nick>(?i:' + re.escape(nick) + ')!)')
+    parts.append('(?i:' + re.escape(prefs['prefix']) + ')(?P<cmd>[^ ]*)')
+    regex = re.compile(r'(?P<off>\[off\])?(?:<(?P<relay>[^\W_][^ ]*)> )?'
+                       r'[ \t\r\n]*(?:' + '|'.join(parts) + ')?')
+
+    if '' in starts:
+        starts = None
+    return regex, starts
+
+_kinds = {'yay': REPLY, 'ouch': REPLY, 'nick': REPLY, 'cmd': TEMPCMD}
+
+# Sort a message into IGNORE, REPLY, STATIC or TEMPCMD without lowercasing or
+#   slicing the whole message. Returns the kind, the RegEx match (or None if
+#   the message was ignored based on its first character) and, for commands,
+#   the message text (without [off], relayed nicks and surrounding whitespace)
+#   and the lowercase command name.
+def triage(prefs, nick, msg):
+    cache = prefs['triage']
+    try:
+        regex, starts = cache[nick]
+    except KeyError:
+        regex, starts = cache[nick] = compile_triage(prefs, nick)
+
+    # Most messages are ignored, so check the first character before running
+    #   the RegEx.
+    if starts is not None and msg[:1].lower() not in starts:
+        return IGNORE, None, None, None
+
+    match = regex.match(msg)
+    kind = _kinds.get(match.lastgroup, IGNORE)
+    if kind != TEMPCMD:
+        return kind, match, None, None
+
+    # Neither the prefix nor the command name can include trailing whitespace
+    start = match.start('cmd') - len(prefs['prefix'])
+    text = msg[start:].rstrip(' \t\r\n')
+    if len(text) < len(prefs['prefix']):
+        return IGNORE, match, None, None
+    cmd = match['cmd'][:len(text) - len(prefs['prefix'])].lower()
+    if prefs['static_cmds'] and cmd in static_cmds.commands:
+        return STATIC, match, text, cmd
+    return TEMPCMD, match, text, cmd
+
 # The bot class
 class Bot:
     # Make sure config values exist
@@ -59,16 +127,30 @@ class Bot:
             res.add(regex_ignore)
         return re.compile('^(' + ')|('.join(res) + ')$', re.IGNORECASE)
 
-    # Add extra items
-    def _add_extras(self, section, c, irc):
-        p = {}
-        self._prefs[irc] = p
-
-        # Add message handlers
+    # Get the settings from [core] that are used when handling messages
+    def _core_prefs(self):
+        return {
+            'global_ignores': self.process_ignores('core'),
+            'prefix':         self.config['core']['prefix'],
+            'static_cmds':    self._conf_bool('core', 'enable_static_cmds',
+                                              True),
+            'disable_yay':    self._conf_bool('core', 'disable_yay'),
+            'disable_ouch':   self._conf_bool('core', 'disable_ouch'),
+        }
+
+    # Add message handlers
+    def _add_handlers(self, section, irc):
         irc.Handler('PRIVMSG', colon=False)(self.handle_privmsg)
         if section != 'discord':
             irc.Handler('INVITE', colon=False)(self._handle_invite)
 
+    # Add extra items, prefs is the dict to add the connection's preferences
+    #   to and core_prefs is from _core_prefs().
+    def _add_extras(self, section, c, irc, prefs, core_prefs):
+        p = dict(core_prefs, network=section)
+        p['triage'] = {}  # Triage RegExes by nick (see triage())
+        prefs[irc] = p
+
         # Process the ignores list
         if 'ignored' in c:
             p['ignored'] = self.process_ignores(section)
@@ -86,183 +168,305 @@ class Bot:
         if self._conf_bool(section, 'auto_accept_invites', False):
             p['auto_accept_invites'] = True
 
+    # Record incoming traffic (for lurklite.traffic). Messages are recorded
+    #   when they arrive (in _classify()) so that the timestamps aren't
+    #   affected by queueing and shed messages are still recorded.
+    def _record(self, irc, event, hostmask, args):
+        prefs = self._prefs.get(irc)
+        if prefs is None:
+            return
+
+        # This may be called from receive threads, so errors are not raised.
+        try:
+            self.recorder.record(prefs['network'], event, hostmask, args)
+        except (OSError, ValueError) as e:
+            print('WARNING: Unable to record traffic!', repr(e))
+
     # Handle PRIVMSGs
     def handle_privmsg(self, irc, hostmask, args):
+        # Connections without an executor (such as Matrix) start handlers as
+        #   soon as messages arrive, so they are recorded here instead.
+        if self.recorder and getattr(irc, '_executor', None) is None:
+            self._record(irc, 'PRIVMSG', hostmask, args)
+
+        # Wait for the command database and custom commands to load
+        if not self._ready.is_set():
+            self._ready.wait()
+
+        # The preferences are only looked up once so that config reloads are
+        #   atomic.
+        prefs = self._prefs.get(irc)
+        if prefs is None:
+            return
+
         # Check for ignored users
         h = '{}!{}@{}'.format(*hostmask)
-        _ignores = self._prefs[irc].get('ignored')
-        if self.ignores.match(h) or (_ignores and _ignores.match(h)):
+        _ignores = prefs.get('ignored')
+        if prefs['global_ignores'].match(h) or (_ignores and _ignores.match(h)):
             return
 
         # Handle PMs correctly
         if args[0].lower() == irc.current_nick.lower():
             args[0] = hostmask[0]
 
+        # Sort the message, unprefixed messages are ignored here.
+        kind, match, msg, cmd = triage(prefs, irc.current_nick, args[-1])
+        if kind == IGNORE:
+            return
+
         # [off] handling
-        msg = args[-1]
-        reply_prefix = ''
-        if msg.startswith('[off]'):
-            reply_prefix = '[off] '
-            msg = msg[5:]
+        reply_prefix = '[off] ' if match['off'] else ''
 
         # Relayed nick handling
-        if msg.startswith('<'):
-            n = msg.split(' ', 1)
-            if n[0].endswith('>') and len(n) > 1 and msg[1].isalnum():
-                _nick = n[0][1:-1]
-                hostmask = (
-                    _nick + '@' + hostmask[0],
-                    hostmask[1],
-                    hostmask[2] + '/relayed/' + _nick
-                )
-                msg = n[1]
-
-        # Remove any leading/trailing spaces
-        msg      = msg.strip(' \t\r\n')
-        args[-1] = msg
-        msg      = msg.lower()
+        _nick = match['relay']
+        if _nick:
+            hostmask = (
+                _nick + '@' + hostmask[0],
+                hostmask[1],
+                hostmask[2] + '/relayed/' + _nick
+            )
 
         # Unprefixed commands here
-        if not self.disable_yay and msg.startswith('yay'):
-            irc.msg(args[0], reply_prefix + '\u200bYay!')
-        elif not self.disable_ouch and msg.startswith('ouch'):
-            irc.msg(args[0], reply_prefix + '\u200bOuch.')
-        elif msg.startswith(irc.current_nick.lower() + '!'):
-            irc.msg(args[0], reply_prefix + hostmask[0] + '!')
-        else:
-            # "Static" commands
-            prefix = self.cmd_db.prefix
-            if msg.startswith(prefix) and self.static_cmds:
-                cmd = msg[len(prefix):].split(' ', 1)[0]
-
-                if cmd in static_cmds.commands:
-                    # Decide if the user is an admin
-                    admins = self._prefs[irc].get('admins', ())
-                    host = hostmask[2]
-
-                    if type(irc).__name__ == 'Discord':
-                        # Discord privileges are checked against both the user
-                        # ID and username#discriminator.
-                        if (host.startswith('discord/user/<') and
-                                host[15:-1] in admins):
-                            # Admin from user ID
-                            is_admin = host[15:-1]
-                        elif ('#' in hostmask[1] and
-                                hostmask[1].lower() in admins):
-                            # Admin from username#discriminator
-                            is_admin = hostmask[1]
-                        else:
-                            # Not an admin
-                            is_admin = False
-                    else:
-                        # IRC privileges are just checked against the hostname.
-                        is_admin = host.lower() in admins and host
+        if kind == REPLY:
+            if match.lastgroup == 'yay':
+                irc.msg(args[0], reply_prefix + '\u200bYay!')
+            elif match.lastgroup == 'ouch':
+                irc.msg(args[0], reply_prefix + '\u200bOuch.')
+            else:
+                irc.msg(args[0], reply_prefix + hostmask[0] + '!')
+
+        # "Static" commands
+        elif kind == STATIC:
+            # Decide if the user is an admin
+            admins = prefs.get('admins', ())
+            host = hostmask[2]
+
+            if type(irc).__name__ == 'Discord':
+                # Discord privileges are checked against both the user ID
+                # and username#discriminator.
+                if (host.startswith('discord/user/<') and
+                        host[15:-1] in admins):
+                    # Admin from user ID
+                    is_admin = host[15:-1]
+                elif ('#' in hostmask[1] and
+                        hostmask[1].lower() in admins):
+                    # Admin from username#discriminator
+                    is_admin = hostmask[1]
+                else:
+                    # Not an admin
+                    is_admin = False
+            else:
+                # IRC privileges are just checked against the hostname.
+                is_admin = host.lower() in admins and host
 
-                    # Launch the command
-                    args[-1] = args[-1][len(cmd) + len(prefix) + 1:]
-                    func = static_cmds.commands[cmd]
+            # Launch the command
+            args[-1] = msg[len(prefs['prefix']) + len(cmd) + 1:]
+            func = static_cmds.commands[cmd]
+            self._audit('command', irc, hostmask, args[0], cmd, 'static')
+            try:
+                with self._track(irc, hostmask, args[0], cmd, 'static'):
                     if hasattr(func, '_lurklite_self'):
                         return func(self, irc, hostmask, is_admin, args)
                     else:
                         return func(irc, hostmask, is_admin, args)
+            except Exception as e:
+                self._audit('error', irc, hostmask, args[0], cmd,
+                            f'{type(e).__name__}: {e}')
+                raise
 
-            # Call the command handler
-            self.cmd_db(irc, hostmask, args, reply_prefix=reply_prefix or None)
+        # Call the command handler
+        else:
+            args[-1] = msg
+            self.cmd_db(irc, hostmask, args, reply_prefix=reply_prefix or None,
+                        prefix=prefs['prefix'],
+                        namespace=self._namespace(irc, prefs, args[0]))
+
+    # Add a record to the audit log (if enabled)
+    def _audit(self, event, irc, hostmask, channel, command, detail=None):
+        if self.audit_log:
+            self.audit_log.record(event,
+                self._prefs.get(irc, {}).get('network'),
+                channel, '{}!{}@{}'.format(*hostmask), command, detail)
+
+    # Decide how important a message is for admission control (see
+    #   admission.py). This is called from receive threads, so it only does
+    #   enough work to tell static commands, tempcmds and chatter apart.
+    def _classify(self, fn, args):
+        if fn != self.handle_privmsg:
+            if self.recorder and fn == self._handle_invite:
+                self._record(args[0], 'INVITE', args[1], args[2])
+            return admission.HIGH, None
+
+        if self.recorder:
+            self._record(args[0], 'PRIVMSG', args[1], args[2])
+
+        irc, hostmask, params = args
+        prefs = self._prefs.get(irc)
+        if prefs is None:
+            return admission.LOW, None
+
+        target = params[0]
+        if target.lower() == irc.current_nick.lower():
+            target = hostmask[0]
+
+        kind, _, _, cmd = triage(prefs, irc.current_nick, params[-1])
+        if kind == STATIC:
+            return admission.HIGH, None
+
+        elif kind == TEMPCMD:
+            # Don't wait for the command database to load here
+            if not self._ready.is_set():
+                return admission.NORMAL, None
+
+            namespace = self._namespace(irc, prefs, target)
+            command = self.cmd_db.get(cmd, namespace=namespace)
+            if command and command.type not in ('url', 'lambda', 'nodejs'):
+                return admission.NORMAL, None
+
+            # Commands that use the caller's nick or hostmask are never
+            #   coalesced.
+            if command and tempcmds.depends_on_caller(command):
+                return admission.LOW, None
+
+        # Identical low priority messages from the same user to the same
+        #   channel are coalesced when the bot is overloaded.
+        return admission.LOW, (prefs['network'], target,
+                               '{}!{}@{}'.format(*hostmask), params[-1])
+
+    # Get the tempcmd namespace for a message target (see tempcmds.py), PMs
+    #   only use the network's tempcmds.
+    def _namespace(self, irc, prefs, target):
+        chantypes = getattr(irc, 'isupport', {}).get('CHANTYPES') or '#&!'
+        if target[:1] in chantypes:
+            return prefs['network'], target.lower()
+        return prefs['network'], None
+
+    # Get the admission control limits
+    def _admission_limits(self):
+        try:
+            max_queue = int(self.config['core'].get('max_queue', 256))
+            max_latency = float(self.config['core'].get('max_latency', 30))
+            assert max_queue > 0 and max_latency > 0
+        except (AssertionError, ValueError):
+            err('Config values \'max_queue\' and \'max_latency\' (in section '
+                '\'core\') must be positive numbers.')
+        return max_queue, max_latency
+
+    # Get the [tempcmds] config with numeric values parsed
+    def _tempcmds_config(self):
+        if 'tempcmds' not in self.config:
+            return {}
+
+        c = dict(self.config['tempcmds'])
+        try:
+            c['url_max_bytes'] = int(c.get('url_max_bytes', 65536))
+            assert c['url_max_bytes'] > 0
+        except (AssertionError, ValueError):
+            err('Config value \'url_max_bytes\' (in section \'tempcmds\') '
+                'must be a positive integer.')
+        return c
+
+    # Time a phase of startup (see --startup-profile), background phases run
+    #   while connecting to networks.
+    @contextlib.contextmanager
+    def _startup_phase(self, name, *, background=False):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.startup_profile.append((name, time.perf_counter() - start,
+                                         background))
+
+    # Load the command database and custom commands, messages are not handled
+    #   until this has finished.
+    def _load_in_background(self, custom_cmds):
+        try:
+            with self._startup_phase('command database', background=True):
+                self.cmd_db.reload()
+            if custom_cmds:
+                with self._startup_phase('custom commands', background=True):
+                    static_cmds.load_cmd_file(custom_cmds)
+        except Exception:
+            print('WARNING: Failed to load custom commands!')
+            traceback.print_exc()
+        finally:
+            self._ready.set()
+
+    # Wait until the bot is ready to handle messages, returns False if timeout
+    #   expires first.
+    def wait_until_ready(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    # Track a running command (see inflight.py)
+    def _track(self, irc, hostmask, channel, command, cmd_type):
+        return self.inflight.track(command, cmd_type,
+            self._prefs.get(irc, {}).get('network'), channel,
+            '{}!{}@{}'.format(*hostmask))
+
+    # Update the Discord server count (called from the scheduler)
+    def _update_discord_status(self, irc):
+        if not irc.connected:
+            return
 
-        # Update the Discord server count
-        if 'next_update' in self._prefs[irc] and \
-                time.time() > self._prefs[irc]['next_update']:
-            c = irc.get_server_count()
-            irc.quote('AWAY', ':{} guild{}. | {}help'.format(
-                c, '' if c == 1 else 's', self.cmd_db.prefix
-            ), tags = {'+discordapp.com/type': 'watching'})
-            irc.debug('Updated Discord status text.')
-            self._prefs[irc]['next_update'] = time.time() + 60
+        c = irc.get_server_count()
+        irc.quote('AWAY', ':{} guild{}. | {}help'.format(
+            c, '' if c == 1 else 's', self.cmd_db.prefix
+        ), tags = {'+discordapp.com/type': 'watching'})
+        irc.debug('Updated Discord status text.')
 
     # Accept invites from admins
     def _handle_invite(self, irc, hostmask, args):
-        prefs = self._prefs[irc]
+        prefs = self._prefs.get(irc)
+        if prefs is None:
+            return
+
+        if self.recorder and getattr(irc, '_executor', None) is None:
+            self._record(irc, 'INVITE', hostmask, args)
+
         if (prefs.get('auto_accept_invites') or
                 hostmask[2].lower() in prefs.get('admins', ())):
             irc.send('JOIN', args[-1])
 
-    # The init function
-    def __init__(self, config, *, debug=False):
-        self.config = config
-        if 'core' not in config:
-            err('Invalid or non-existent config file!')
-        self._conf_assert('core', 'command_db', 'prefix')
-        self.ignores = self.process_ignores('core')
-        self._prefs = {}
-
-        # Create the commands database
-        if 'tempcmds' in config:
-            tempcmds_config = config['tempcmds']
-        else:
-            tempcmds_config = {}
-        self.cmd_db = tempcmds.CommandDatabase(config['core']['command_db'],
-            config=tempcmds_config, prefix=config['core']['prefix'],
-            reply_on_invalid=self._conf_bool('core', 'reply_on_invalid'))
-
-        # Get the "enable_static_cmds" flag
-        global static_cmds
-        self.static_cmds = self._conf_bool('core', 'enable_static_cmds', True)
-
-        if self.static_cmds:
-            if static_cmds is None:
-                import lurklite.static_cmds as static_cmds
-
-            # Get the custom commands file
-            custom_cmds = config['core'].get('custom_cmds')
-            if custom_cmds:
-                static_cmds.load_cmd_file(custom_cmds)
-        elif 'custom_cmds' in config['core']:
-            print('WARNING: A custom commands path is specified, but static co'
-                'mmands are disabled! The custom commands will not be loaded.')
-
-        # Get the disable yay/ouch flags
-        self.disable_yay  = self._conf_bool('core', 'disable_yay')
-        self.disable_ouch = self._conf_bool('core', 'disable_ouch')
-
-        thread_pool = concurrent.futures.ThreadPoolExecutor(32)
-
-        # Get the IRC servers to connect to
-        _servers = {}
-        kwargs   = None
-        for section in config.sections():
-            if section == 'irc' or section.startswith('irc.'):
-                self._conf_assert(section, 'ip', ('port', int), 'nick',
-                    'channels')
-
-                c = config[section]
-                kwargs = {}
-
-                for i in 'ident', 'realname', 'ns_identity', 'connect_modes', \
-                  'quit_message':
-                    if i in c:
-                        kwargs[i] = c[i]
-
-                # Add the SSL option
-                ssl = None
-                if 'tls' in c:
-                    ssl = 'tls'
-                elif 'ssl' in c:
-                    ssl = 'ssl'
-
-                if ssl:
-                    kwargs['ssl'] = self._conf_bool(section, ssl)
-
-                # Create the IRC object
-                irc = miniirc.IRC(c['ip'], int(c['port']), c['nick'],
-                    c['channels'].split(','), auto_connect=False,
-                    debug=debug, executor=thread_pool, **kwargs)
-                _servers[section] = irc
-
-                # Add the ignores list
-                self._add_extras(section, c, irc)
+    # Create IRC (or Discord/Matrix) objects, this exists so that subclasses
+    #   can use different transports.
+    def _create_irc(self, section, cls, *args, **kwargs):
+        return cls(*args, **kwargs)
+
+    # Create the IRC (or Discord/Matrix) object for a config section, returns
+    #   None if the section isn't a network.
+    def _create_network(self, section):
+        config = self.config
+        debug = self._debug
+        if section == 'irc' or section.startswith('irc.'):
+            self._conf_assert(section, 'ip', ('port', int), 'nick',
+                'channels')
+
+            c = config[section]
+            kwargs = {}
+
+            for i in 'ident', 'realname', 'ns_identity', 'connect_modes', \
+              'quit_message':
+                if i in c:
+                    kwargs[i] = c[i]
+
+            # Add the SSL option
+            ssl = None
+            if 'tls' in c:
+                ssl = 'tls'
+            elif 'ssl' in c:
+                ssl = 'ssl'
+
+            if ssl:
+                kwargs['ssl'] = self._conf_bool(section, ssl)
+
+            # Create the IRC object
+            return self._create_irc(section, miniirc.IRC, c['ip'],
+                int(c['port']), c['nick'],
+                c['channels'].split(','), auto_connect=False,
+                debug=debug, executor=self._executor, **kwargs)
 
         # Get the Discord bot account (if any)
-        if 'discord' in config:
+        elif section == 'discord':
             try:
                 import miniirc_discord
             except ImportError:
@@ -281,15 +485,11 @@ class Bot:
             c = config['discord']
 
             # Create the Discord object
-            irc = miniirc_discord.Discord(c['token'], 0,
-                c.get('nick', '???'), debug=debug, executor=thread_pool, **kw)
-            _servers['Discord'] = irc
-
-            # Add the ignores list
-            self._add_extras('discord', c, irc)
-            self._prefs[irc]['next_update'] = 0
+            return self._create_irc('discord', miniirc_discord.Discord,
+                c['token'], 0, c.get('nick', '???'), debug=debug,
+                executor=self._executor, **kw)
 
-        if 'matrix' in config:
+        elif section == 'matrix':
             try:
                 import miniirc_matrix
             except ImportError:
@@ -301,25 +501,287 @@ class Bot:
             ssl = True
             if 'ssl' in c:
                 ssl = self._conf_bool('matrix', 'ssl')
-            irc = miniirc_matrix.Matrix(c['homeserver'], auto_connect=False,
-                                        debug=debug, token=c['token'], ssl=ssl)
-            _servers['Matrix'] = irc
-            self._add_extras('matrix', c, irc)
-
-        # Mass connect
-        for name, irc in _servers.items():
-            irc.debug('Connecting to ' + repr(name) + '...')
+            return self._create_irc('matrix', miniirc_matrix.Matrix,
+                c['homeserver'], auto_connect=False, debug=debug,
+                token=c['token'], ssl=ssl)
+
+        return None
+
+    # Add handlers and connect to newly created networks
+    def _connect(self, servers):
+        for section, irc in servers.items():
+            self._add_handlers(section, irc)
+            if section == 'discord':
+                self._discord_job = self.scheduler.call_every(60,
+                    self._update_discord_status, irc, delay=5)
+
+        for section, irc in servers.items():
+            irc.debug('Connecting to ' + repr(section) + '...')
             try:
                 irc.connect()
             except Exception as exc:
-                print(f'Failed to connect to {name!r} - '
+                print(f'Failed to connect to {section!r} - '
                       f'{exc.__class__.__name__}: {exc}')
 
-        irc.debug('Finished connecting to servers!')
+        if servers:
+            irc.debug('Finished connecting to servers!')
+
+    # Import static_cmds if static commands are enabled
+    def _load_static_cmds(self):
+        global static_cmds
+        if self._conf_bool('core', 'enable_static_cmds', True):
+            if static_cmds is None:
+                import lurklite.static_cmds as static_cmds
+            return True
+        return False
+
+    # Reload the config file (or use config) without reconnecting to networks
+    #   that haven't been added or removed. Returns lists of the added and
+    #   removed network sections.
+    def reload_config(self, config=None):
+        with self._reload_lock:
+            if config is None:
+                if not self.config_file:
+                    err('There is no config file to reload!')
+                config = configparser.ConfigParser()
+                config.read(self.config_file)
+
+            if 'core' not in config:
+                err('Invalid or non-existent config file!')
+
+            old_config, self.config = self.config, config
+            try:
+                self._conf_assert('core', 'command_db', 'prefix')
+                core_prefs = self._core_prefs()
+                reply_on_invalid = self._conf_bool('core', 'reply_on_invalid')
+                max_queue, max_latency = self._admission_limits()
+                tempcmds_config = self._tempcmds_config()
+                self._load_static_cmds()
+
+                # Keep existing connections
+                prefs = {}
+                removed = {}
+                for irc, p in self._prefs.items():
+                    section = p['network']
+                    if section in config:
+                        self._add_extras(section, config[section], irc, prefs,
+                                         core_prefs)
+                    else:
+                        removed[section] = irc
+
+                # Create new ones
+                added = {}
+                current = {p['network'] for p in self._prefs.values()}
+                for section in config.sections():
+                    if section not in current:
+                        irc = self._create_network(section)
+                        if irc is not None:
+                            added[section] = irc
+                            self._add_extras(section, config[section], irc,
+                                             prefs, core_prefs)
+            except:
+                self.config = old_config
+                raise
+
+            for key in 'command_db', 'record_traffic':
+                if old_config['core'].get(key) != config['core'].get(key):
+                    print(f'WARNING: Changes to {key!r} will not be applied '
+                          f'until the bot is restarted.')
+            for section in 'audit', 'replication':
+                if (section in old_config and dict(old_config[section])) != \
+                        (section in config and dict(config[section])):
+                    print(f'WARNING: Changes to [{section}] will not be '
+                          f'applied until the bot is restarted.')
+
+            # Switch over
+            self.ignores      = core_prefs['global_ignores']
+            self.static_cmds  = core_prefs['static_cmds']
+            self.disable_yay  = core_prefs['disable_yay']
+            self.disable_ouch = core_prefs['disable_ouch']
+            self.cmd_db.prefix = core_prefs['prefix']
+            self.cmd_db.reply_on_invalid = reply_on_invalid
+            self._executor.max_queue = max_queue
+            self._executor.max_latency = max_latency
+            self.cmd_db.set_config(tempcmds_config)
+            self._prefs = prefs
+
+            # Disconnect from removed networks
+            for section, irc in removed.items():
+                irc.debug('Disconnecting from ' + repr(section) + '...')
+                if section == 'discord' and self._discord_job:
+                    self._discord_job.cancel()
+                    self._discord_job = None
+                irc.disconnect()
+
+            # Join and part channels on existing IRC networks
+            for irc, p in prefs.items():
+                section = p['network']
+                if section not in added and section in old_config and \
+                        'channels' in config[section]:
+                    old = {channel.strip() for channel in
+                           old_config[section].get('channels', '').split(',')}
+                    new = {channel.strip() for channel in
+                           config[section]['channels'].split(',')}
+                    for channel in new - old:
+                        irc.channels.add(channel)
+                        if irc.connected:
+                            irc.send('JOIN', channel)
+                    for channel in old - new:
+                        irc.channels.discard(channel)
+                        if irc.connected:
+                            irc.send('PART', channel)
+
+            self._connect(added)
+            return list(added), list(removed)
+
+    # Create the replication.Replicator
+    def _create_replicator(self):
+        global replication
+        if replication is None:
+            import lurklite.replication as replication
+        import socket
+
+        config = self.config
+        c = config['replication']
+        try:
+            interval = float(c.get('interval', 5))
+            compact_interval = float(c.get('compact_interval', 3600))
+            assert interval > 0 and compact_interval > 0
+        except (AssertionError, ValueError):
+            err('Config values \'interval\' and \'compact_interval\' (in '
+                'section \'replication\') must be positive numbers.')
+
+        journal = replication.Journal(
+            c.get('journal', config['core']['command_db'] + '.journal'),
+            c.get('node_id', socket.gethostname()))
+        peers = [peer.strip() for peer in c.get('peers', '').split(',')
+                 if peer.strip()]
+        self.replicator = replication.Replicator(self.cmd_db, journal,
+            peers=peers, listen=c.get('listen'), token=c.get('token'))
+        if peers:
+            self.replicator.start(interval)
+        self.scheduler.call_every(compact_interval, journal.compact)
+
+    # The init function
+    def __init__(self, config, *, debug=False, config_file=None):
+        self.config = config
+        self.config_file = config_file
+        if 'core' not in config:
+            err('Invalid or non-existent config file!')
+        self._conf_assert('core', 'command_db', 'prefix')
+        core_prefs = self._core_prefs()
+        self.ignores = core_prefs['global_ignores']
+        self._prefs = {}
+        self._debug = debug
+        self._reload_lock = threading.Lock()
+        self._discord_job = None
+        self._ready = threading.Event()
+        self.startup_profile = []
+        self.scheduler = scheduler.Scheduler()
+
+        # Create the commands database, it is loaded in the background (see
+        #   _load_in_background()).
+        self.cmd_db = tempcmds.CommandDatabase(config['core']['command_db'],
+            config=self._tempcmds_config(), prefix=config['core']['prefix'],
+            reply_on_invalid=self._conf_bool('core', 'reply_on_invalid'))
+        self.cmd_db.schedule(self.scheduler)
+
+        # Keep track of running commands and log slow ones
+        self.inflight = inflight.Tracker()
+        self.cmd_db.track = self._track
+        try:
+            threshold = float(config['core'].get('slow_command_threshold', 10))
+        except ValueError:
+            err('Config value \'slow_command_threshold\' (in section '
+                '\'core\') contains an invalid float.')
+        self.scheduler.call_every(1, self.inflight.check_slow, threshold)
+
+        # Set up replication, this loads the command database immediately.
+        self.replicator = None
+        if 'replication' in config:
+            with self._startup_phase('replication'):
+                self._create_replicator()
+
+        # Record incoming traffic (for lurklite.traffic)
+        global traffic
+        self.recorder = None
+        if 'record_traffic' in config['core']:
+            if traffic is None:
+                import lurklite.traffic as traffic
+            self.recorder = traffic.Recorder(config['core']['record_traffic'])
+            self.scheduler.call_every(1, self.recorder.flush)
+
+        # Create the audit log
+        global audit
+        self.audit_log = None
+        if 'audit' in config:
+            self._conf_assert('audit', 'file')
+            if audit is None:
+                import lurklite.audit as audit
+
+            c = config['audit']
+            try:
+                max_size = int(c.get('max_size', 10485760))
+                backups  = int(c.get('backups', 5))
+            except ValueError:
+                err('Config values \'max_size\' and \'backups\' (in section '
+                    '\'audit\') must be integers.')
+
+            self.audit_log = audit.AuditLog(c['file'], max_size=max_size,
+                backups=backups, use_json=c.get('format', '').lower() == 'json')
+            self.cmd_db.audit = self._audit
+
+        # Get the "enable_static_cmds" flag
+        with self._startup_phase('static commands'):
+            self.static_cmds = self._load_static_cmds()
+
+        # Get the custom commands file
+        custom_cmds = None
+        if self.static_cmds:
+            custom_cmds = config['core'].get('custom_cmds')
+        elif 'custom_cmds' in config['core']:
+            print('WARNING: A custom commands path is specified, but static co'
+                'mmands are disabled! The custom commands will not be loaded.')
+
+        # Get the disable yay/ouch flags
+        self.disable_yay  = core_prefs['disable_yay']
+        self.disable_ouch = core_prefs['disable_ouch']
+
+        # Create the thread pool
+        max_queue, max_latency = self._admission_limits()
+        self._executor = admission.AdmissionExecutor(32,
+            classify=self._classify, max_queue=max_queue,
+            max_latency=max_latency)
+
+        # Get the servers to connect to
+        servers = {}
+        with self._startup_phase('networks'):
+            for section in config.sections():
+                irc = self._create_network(section)
+                if irc is not None:
+                    servers[section] = irc
+                    self._add_extras(section, config[section], irc,
+                                     self._prefs, core_prefs)
+
+        # Load the command database and custom commands while connecting
+        threading.Thread(target=self._load_in_background, args=(custom_cmds,),
+                         name='lurklite-startup', daemon=True).start()
+        self.scheduler.start()
+
+        # Mass connect
+        with self._startup_phase('connect'):
+            self._connect(servers)
 
+    # Networks may be added while waiting (see reload_config()).
     def wait_until_disconnected(self):
-        for irc in self._prefs:
-            irc.wait_until_disconnected()
+        waited = set()
+        while True:
+            pending = [irc for irc in self._prefs if irc not in waited]
+            if not pending:
+                break
+            for irc in pending:
+                irc.wait_until_disconnected()
+                waited.add(irc)
 
 # Ensure miniirc isn't outdated
 assert miniirc.ver >= (1,8,0), 'lurklite requires miniirc >= v1.8.0!'
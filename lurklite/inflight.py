@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+#
+# In-flight command tracking - Keeps track of running commands so that they
+#   can be inspected and cancelled.
+#
+
+import contextlib, itertools, threading, time
+
+_current = threading.local()
+
+class Cancelled(Exception):
+    pass
+
+# A running command
+class Entry:
+    upstream  = None
+    cancelled = False
+    reported  = False
+
+    def __init__(self, id, command, type, network, channel, user):
+        self.id      = id
+        self.command = command
+        self.type    = type
+        self.network = network
+        self.channel = channel
+        self.user    = user
+        self.started = time.monotonic()
+
+    def __repr__(self):
+        return f'<inflight.Entry #{self.id} {self.command!r}>'
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    # Cancellation is cooperative, commands check for it while waiting for
+    #   upstream servers (see check_cancelled()).
+    def cancel(self):
+        self.cancelled = True
+
+# Get the entry for the command running in this thread (if any)
+def current():
+    return getattr(_current, 'entry', None)
+
+# Set the upstream host of the current command
+def set_upstream(host):
+    entry = current()
+    if entry is not None:
+        entry.upstream = host
+
+# Raise Cancelled if the current command has been cancelled
+def check_cancelled():
+    entry = current()
+    if entry is not None and entry.cancelled:
+        raise Cancelled(f'Command #{entry.id} was cancelled.')
+
+# The registry of running commands
+class Tracker:
+    def __init__(self):
+        self.slow_count = 0
+        self._entries   = {}
+        self._ids       = itertools.count(1)
+        self._lock      = threading.Lock()
+
+    def __repr__(self):
+        return f'<inflight.Tracker with {len(self._entries)} command(s)>'
+
+    @contextlib.contextmanager
+    def track(self, command, type, network, channel, user):
+        entry = Entry(next(self._ids), command, type, network, channel, user)
+        with self._lock:
+            self._entries[entry.id] = entry
+
+        previous = current()
+        _current.entry = entry
+        try:
+            yield entry
+        finally:
+            _current.entry = previous
+            with self._lock:
+                del self._entries[entry.id]
+
+    # Get running commands, oldest first
+    def entries(self):
+        with self._lock:
+            return sorted(self._entries.values(), key=lambda e : e.id)
+
+    def cancel(self, id):
+        with self._lock:
+            entry = self._entries.get(id)
+        if entry is None:
+            return False
+        entry.cancel()
+        return True
+
+    # Log (and count) commands that have been running for longer than
+    #   threshold seconds, this is called from the scheduler.
+    def check_slow(self, threshold):
+        for entry in self.entries():
+            if not entry.reported and entry.elapsed > threshold:
+                entry.reported = True
+                self.slow_count += 1
+                print(f'WARNING: Command #{entry.id} ({entry.command!r}, '
+                      f'type {entry.type!r}) has been running for '
+                      f'{entry.elapsed:.1f}s on {entry.network!r}/'
+                      f'{entry.channel!r} (started by {entry.user!r}, '
+                      f'upstream {entry.upstream!r}).')
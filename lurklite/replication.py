@@ -0,0 +1,246 @@
+#!/usr/bin/python3
+#
+# Replication - Shares tempcmd changes between bots on different hosts
+#
+# Every change to a CommandDatabase is recorded in a journal as a versioned
+#   change record. Peers pull the records newer than the last version they
+#   have seen over HTTP (GET /changes?since=<version>), and conflicting changes
+#   are resolved by timestamp (with the origin's node ID as a tie-breaker).
+#
+
+import bisect, collections, http.server, json, threading, time, \
+    urllib.parse, urllib.request
+import lurklite.snapshot as snapshot
+
+Change = collections.namedtuple('Change',
+                                'version timestamp origin key value')
+
+# The change journal, stored as JSON lines. Versions are local to each bot.
+class Journal:
+    def __init__(self, location, node_id):
+        self.location  = location
+        self.node_id   = node_id
+        self.version   = 0
+        self._records  = []
+        self._versions = []
+        self._clocks   = {}
+        self._lock     = threading.Lock()
+
+        try:
+            with open(location, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        self._add(Change(*json.loads(line)))
+        except FileNotFoundError:
+            pass
+
+        self._file = open(location, 'a', encoding='utf-8')
+
+    def __repr__(self):
+        return 'replication.Journal(' + repr(self.location) + ')'
+
+    def _add(self, record):
+        self._records.append(record)
+        self._versions.append(record.version)
+        self._clocks[record.key] = (record.timestamp, record.origin)
+        self.version = record.version
+
+    # Append records with new local versions, the caller must hold the
+    #   CommandDatabase lock.
+    def append(self, records):
+        with self._lock:
+            lines = []
+            for record in records:
+                record = record._replace(version=self.version + 1)
+                self._add(record)
+                lines.append(json.dumps(record, separators=(',', ':')) + '\n')
+            self._file.writelines(lines)
+            self._file.flush()
+
+    # Record local changes, timestamps are kept ahead of any earlier change to
+    #   the same command so that local changes are never lost to clock skew.
+    def record_local(self, changes):
+        now = time.time()
+        records = []
+        for key, value in changes:
+            ts = now
+            if key in self._clocks:
+                ts = max(ts, self._clocks[key][0] + 0.001)
+            records.append(Change(0, ts, self.node_id, key, value))
+        self.append(records)
+
+    # Record existing commands with a timestamp of 0 so that any real change
+    #   takes priority.
+    def bootstrap(self, items):
+        self.append([Change(0, 0, self.node_id, key, value)
+                     for key, value in items])
+
+    # Filter out records that are older than what has already been applied
+    def newer(self, records):
+        res = {}
+        for record in records:
+            clock = (record.timestamp, record.origin)
+            if clock > self._clocks.get(record.key, (-1, '')) and \
+                    (record.key not in res or
+                     clock > (res[record.key].timestamp,
+                              res[record.key].origin)):
+                res[record.key] = record
+        return list(res.values())
+
+    # Get records newer than since
+    def changes_since(self, since, limit=1000):
+        with self._lock:
+            i = bisect.bisect_right(self._versions, since)
+            return self._records[i:i + limit], self.version
+
+    # Remove records that have been superseded by newer changes to the same
+    #   command.
+    def compact(self):
+        with self._lock:
+            latest = {record.key: record for record in self._records}
+            if len(latest) == len(self._records):
+                return
+
+            records = sorted(latest.values(), key=lambda r : r.version)
+            snapshot.write_atomic(self.location, [(json.dumps(record,
+                separators=(',', ':')) + '\n').encode('utf-8')
+                for record in records], prefix='.journal-')
+
+            self._file.close()
+            self._file = open(self.location, 'a', encoding='utf-8')
+            self._records = records
+            self._versions = [record.version for record in records]
+
+# Serve change records to peers
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        replicator = self.server.replicator
+        if url.path != '/changes':
+            return self.send_error(404)
+        if replicator.token and self.headers.get('Authorization') != \
+                'Bearer ' + replicator.token:
+            return self.send_error(403)
+
+        try:
+            query = urllib.parse.parse_qs(url.query)
+            since = int(query.get('since', ('0',))[0])
+            limit = min(int(query.get('limit', ('1000',))[0]), 1000)
+        except ValueError:
+            return self.send_error(400)
+
+        records, version = replicator.journal.changes_since(since, limit)
+        body = json.dumps({'node': replicator.journal.node_id,
+                           'version': version, 'changes': records},
+                          separators=(',', ':')).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+# Pull changes from peers and serve local changes. The last version pulled
+#   from each peer is saved in the journal's location with ".peers" appended.
+class Replicator:
+    def __init__(self, cmd_db, journal, *, peers=(), listen=None, token=None):
+        self.cmd_db  = cmd_db
+        self.journal = journal
+        self.token   = token
+        self.server  = None
+        self._cursor_location = journal.location + '.peers'
+        self._stop   = threading.Event()
+
+        saved = {}
+        try:
+            with open(self._cursor_location, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            print('WARNING: Unable to read replication peer versions!',
+                  repr(e))
+        self.peers = {}
+        for peer in peers:
+            peer = peer.rstrip('/')
+            self.peers[peer] = saved.get(peer, 0)
+
+        cmd_db.attach_journal(journal)
+        if listen:
+            host, port = listen.rsplit(':', 1)
+            self.server = http.server.ThreadingHTTPServer(
+                (host.strip('[]'), int(port)), _Handler)
+            self.server.daemon_threads = True
+            self.server.replicator = self
+            threading.Thread(target=self.server.serve_forever,
+                             name='lurklite-replication', daemon=True).start()
+
+    def __repr__(self):
+        return f'<replication.Replicator {self.journal.node_id!r}>'
+
+    # Pull changes from a single peer, returns the number applied
+    def pull(self, peer):
+        applied = 0
+        while True:
+            url = f'{peer}/changes?since={self.peers[peer]}'
+            req = urllib.request.Request(url)
+            if self.token:
+                req.add_header('Authorization', 'Bearer ' + self.token)
+            with urllib.request.urlopen(req, timeout=10) as res:
+                data = json.loads(res.read().decode('utf-8'))
+
+            # Start again if the peer's journal has been reset
+            if data['version'] < self.peers[peer]:
+                self.peers[peer] = 0
+                continue
+
+            records = [Change(*record) for record in data['changes']]
+            if records:
+                applied += self.cmd_db.apply_remote(records)
+                self.peers[peer] = records[-1].version
+            else:
+                self.peers[peer] = data['version']
+
+            if self.peers[peer] >= data['version']:
+                return applied
+
+    # Save the last version pulled from each peer
+    def _save_cursors(self):
+        snapshot.write_atomic(self._cursor_location,
+            [json.dumps(self.peers).encode('utf-8')], prefix='.peers-')
+
+    # Pull changes from all peers
+    def pull_all(self):
+        cursors = dict(self.peers)
+        for peer in self.peers:
+            try:
+                self.pull(peer)
+            except Exception as e:
+                print(f'WARNING: Unable to pull changes from {peer!r}:',
+                      repr(e))
+
+        if self.peers != cursors:
+            try:
+                self._save_cursors()
+            except OSError as e:
+                print('WARNING: Unable to save replication peer versions!',
+                      repr(e))
+
+    # Pull changes from all peers every interval seconds on a separate thread,
+    #   since unreachable peers can take a while to time out.
+    def start(self, interval):
+        threading.Thread(target=self._pull_forever, args=(interval,),
+                         name='lurklite-replication-pull', daemon=True).start()
+
+    def _pull_forever(self, interval):
+        while not self._stop.is_set():
+            self.pull_all()
+            self._stop.wait(interval)
+
+    def close(self):
+        self._stop.set()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
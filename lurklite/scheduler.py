@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+#
+# Scheduler - Runs timed and periodic jobs on a dedicated thread
+#
+
+import heapq, itertools, threading, time, traceback
+
+# Scheduled jobs
+class Job:
+    cancelled = False
+
+    def __init__(self, func, args, interval):
+        self.func     = func
+        self.args     = args
+        self.interval = interval
+
+    def __repr__(self):
+        if self.interval is None:
+            return f'<scheduler.Job {self.func!r}>'
+        return f'<scheduler.Job {self.func!r} every {self.interval!r}s>'
+
+    def cancel(self):
+        self.cancelled = True
+
+# The scheduler itself, jobs should be quick as they all share one thread.
+class Scheduler:
+    def __init__(self):
+        self._heap    = []
+        self._counter = itertools.count()
+        self._cond    = threading.Condition()
+        self._thread  = None
+
+    def __repr__(self):
+        return f'<scheduler.Scheduler with {len(self._heap)} job(s)>'
+
+    def _push(self, when, job):
+        with self._cond:
+            heapq.heappush(self._heap, (when, next(self._counter), job))
+            self._cond.notify()
+
+    # Run func(*args) once after delay seconds
+    def call_later(self, delay, func, *args):
+        job = Job(func, args, None)
+        self._push(time.monotonic() + delay, job)
+        return job
+
+    # Run func(*args) every interval seconds, the first call is made after
+    #   delay seconds (or interval seconds if delay is None).
+    def call_every(self, interval, func, *args, delay=None):
+        assert interval > 0, 'The interval must be positive!'
+        job = Job(func, args, interval)
+        self._push(time.monotonic() + (interval if delay is None else delay),
+                   job)
+        return job
+
+    # Start and stop the scheduler thread
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._main,
+                                                name='lurklite-scheduler',
+                                                daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            thread, self._thread = self._thread, None
+            self._cond.notify()
+
+        if thread and thread is not threading.current_thread():
+            thread.join()
+
+    # The main loop
+    def _main(self):
+        thread = threading.current_thread()
+        while True:
+            with self._cond:
+                while self._thread is thread:
+                    if self._heap:
+                        delay = self._heap[0][0] - time.monotonic()
+                        if delay <= 0:
+                            break
+                    else:
+                        delay = None
+                    self._cond.wait(delay)
+                else:
+                    return
+
+                when, _, job = heapq.heappop(self._heap)
+
+            if job.cancelled:
+                continue
+
+            try:
+                job.func(*job.args)
+            except Exception:
+                print('WARNING: Scheduled job', repr(job), 'failed!')
+                traceback.print_exc()
+
+            # Reschedule periodic jobs, skipping any missed runs
+            if job.interval is not None and not job.cancelled:
+                now = time.monotonic()
+                when += job.interval
+                if when < now:
+                    when = now + job.interval
+                self._push(when, job)
@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+#
+# Command database snapshots - A read-optimised format that can be mmap()ed
+#   and shared between processes.
+#
+# Layout (all integers are little-endian):
+#   Header:  magic (8 bytes), value format (u32), record count (u32),
+#            hash table size (u32)
+#   Table:   hash table size * u32 record offsets (0 for empty slots), using
+#            CRC32 of the key with linear probing.
+#   Records: key length (u32), value length (u32), key (UTF-8), value
+#
+
+import json, mmap, os, stat, struct, tempfile, zlib
+
+# Try importing msgpack
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MAGIC = b'LKSNAP01'
+_header = struct.Struct('<8sIII')
+_record = struct.Struct('<II')
+_slot   = struct.Struct('<I')
+
+_FORMAT_MSGPACK = 0
+_FORMAT_JSON    = 1
+
+def _encode_value(value, fmt):
+    if fmt == _FORMAT_MSGPACK:
+        return msgpack.dumps(value)
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+# Check if data (the start of a file) is a snapshot
+def is_snapshot(data):
+    return data.startswith(MAGIC)
+
+# Encode a snapshot of data (a dict), returns a list of chunks (bytes).
+def encode(data):
+    fmt = _FORMAT_MSGPACK if msgpack else _FORMAT_JSON
+    size = 8
+    while size < len(data) * 2:
+        size *= 2
+
+    table = [0] * size
+    records = []
+    offset = _header.size + size * _slot.size
+    for key, value in data.items():
+        key_bytes = key.encode('utf-8')
+        value_bytes = _encode_value(value, fmt)
+
+        slot = zlib.crc32(key_bytes) & (size - 1)
+        while table[slot]:
+            slot = (slot + 1) & (size - 1)
+        table[slot] = offset
+
+        records.append(_record.pack(len(key_bytes), len(value_bytes)))
+        records.append(key_bytes)
+        records.append(value_bytes)
+        offset += _record.size + len(key_bytes) + len(value_bytes)
+
+    return [_header.pack(MAGIC, fmt, len(data), size),
+            struct.pack(f'<{size}I', *table), *records]
+
+# Get the permissions to give a file that replaces location, this is the mode
+#   of the existing file or the umask default for new files.
+def _replacement_mode(location):
+    try:
+        return stat.S_IMODE(os.stat(location).st_mode)
+    except FileNotFoundError:
+        umask = os.umask(0o022)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+# Write chunks (bytes) to a temporary file next to location that can later
+#   be moved over it with os.replace(), returns the temporary file's path. The
+#   permissions of any existing file are kept.
+def write_temp(location, chunks, *, prefix='.tmp-'):
+    dirname = os.path.dirname(os.path.abspath(location))
+    mode = _replacement_mode(location)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix=prefix)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if hasattr(os, 'fchmod'):
+                os.fchmod(f.fileno(), mode)
+            f.writelines(chunks)
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        remove_temp(tmp)
+        raise
+    return tmp
+
+# Remove a temporary file from write_temp() (if it still exists)
+def remove_temp(tmp):
+    try:
+        os.remove(tmp)
+    except OSError:
+        pass
+
+# Write chunks to location so that other processes never see a partially
+#   written file.
+def write_atomic(location, chunks, *, prefix='.tmp-'):
+    tmp = write_temp(location, chunks, prefix=prefix)
+    try:
+        os.replace(tmp, location)
+    except BaseException:
+        remove_temp(tmp)
+        raise
+
+# A read-only mapping backed by a mmap()ed snapshot. Lookups only decode the
+#   requested record.
+class Snapshot:
+    def __init__(self, location, f=None):
+        self.location = location
+        if f is None:
+            with open(location, 'rb') as f:
+                self._open(f)
+        else:
+            self._open(f)
+
+        self._view = memoryview(self._mmap)
+        magic, self._format, self._count, self._size = \
+            _header.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError('Not a command database snapshot!')
+        if self._format == _FORMAT_MSGPACK and not msgpack:
+            raise ImportError('msgpack is required to read this snapshot!')
+
+    def _open(self, f):
+        self.stat = os.fstat(f.fileno())
+        self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __repr__(self):
+        return 'snapshot.Snapshot(' + repr(self.location) + ')'
+
+    def _decode(self, offset, key_len, value_len):
+        value = self._view[offset + key_len:offset + key_len + value_len]
+        if self._format == _FORMAT_MSGPACK:
+            return msgpack.unpackb(value, raw=False)
+        return json.loads(bytes(value))
+
+    def _find(self, key):
+        key = key.encode('utf-8')
+        mask = self._size - 1
+        slot = zlib.crc32(key) & mask
+        while True:
+            offset, = _slot.unpack_from(self._mmap,
+                                        _header.size + slot * _slot.size)
+            if not offset:
+                return None
+
+            key_len, value_len = _record.unpack_from(self._mmap, offset)
+            offset += _record.size
+            if key_len == len(key) and \
+                    self._view[offset:offset + key_len] == key:
+                return offset, key_len, value_len
+            slot = (slot + 1) & mask
+
+    def get(self, key, default=None):
+        res = self._find(key)
+        if res is None:
+            return default
+        return self._decode(*res)
+
+    def __getitem__(self, key):
+        res = self._find(key)
+        if res is None:
+            raise KeyError(key)
+        return self._decode(*res)
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def __len__(self):
+        return self._count
+
+    # Iterate over the records in file order
+    def _records(self):
+        offset = _header.size + self._size * _slot.size
+        for _ in range(self._count):
+            key_len, value_len = _record.unpack_from(self._mmap, offset)
+            offset += _record.size
+            yield offset, key_len, value_len
+            offset += key_len + value_len
+
+    def __iter__(self):
+        for offset, key_len, _ in self._records():
+            yield str(self._view[offset:offset + key_len], 'utf-8')
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        for offset, key_len, value_len in self._records():
+            yield (str(self._view[offset:offset + key_len], 'utf-8'),
+                   self._decode(offset, key_len, value_len))
+
+    def close(self):
+        self._view.release()
+        self._mmap.close()
@@ -3,7 +3,8 @@
 # "Static" commands
 #
 
-import miniirc, os, sys, lurklite.tempcmds as tempcmds, time
+import miniirc, os, sys, lurklite.inflight as inflight, \
+    lurklite.tempcmds as tempcmds, time
 
 commands = {}
 
@@ -73,6 +74,23 @@ def _cmd_reboot(irc, hostmask, is_admin, args):
         subprocess.Popen(argv)
         os._exit(0)
 
+# Reload the config file
+@register_command('rehash', 'reload', with_bot=True, requires_admin=True)
+def _cmd_rehash(bot, irc, hostmask, is_admin, args):
+    try:
+        added, removed = bot.reload_config()
+    except Exception as e:
+        return irc.msg(args[0], f'{hostmask[0]}: Failed to reload the config '
+            f'file! {type(e).__name__}: {e}')
+
+    print(is_admin, 'reloaded the config file.')
+    msg = f'{hostmask[0]}: Reloaded the config file.'
+    if added:
+        msg += ' Added: ' + ', '.join(added) + '.'
+    if removed:
+        msg += ' Removed: ' + ', '.join(removed) + '.'
+    irc.msg(args[0], msg)
+
 # Shutdown
 @register_command('die', 'shutdown', requires_admin=True)
 def _cmd_die(irc, hostmask, is_admin, args):
@@ -89,6 +107,42 @@ def _cmd_privs(irc, hostmask, is_admin, args):
     else:
         irc.msg(args[0], f'{hostmask[0]}: You are not an admin!')
 
+# Inspect and cancel running commands
+@register_command('inflight', with_bot=True, requires_admin=True)
+def _cmd_inflight(bot, irc, hostmask, is_admin, args):
+    """
+    Lists running commands.
+    Usage: inflight [cancel <id>]
+    """
+
+    params = args[-1].split()
+    if len(params) == 2 and params[0] == 'cancel' and params[1].isdigit():
+        if bot.inflight.cancel(int(params[1])):
+            irc.msg(args[0], f'{hostmask[0]}: Command #{params[1]} will be '
+                'cancelled.')
+        else:
+            irc.msg(args[0], f'{hostmask[0]}: Command #{params[1]} is not '
+                'running!')
+        return
+    elif params:
+        return irc.msg(args[0], hostmask[0] + ': Invalid syntax!')
+
+    # Don't include this command
+    entries = [entry for entry in bot.inflight.entries()
+               if entry is not inflight.current()]
+    stats = bot._executor.stats
+    irc.msg(args[0], f'{hostmask[0]}: {len(entries)} command'
+        f'{"" if len(entries) == 1 else "s"} running, '
+        f'{bot._executor.depth} queued, {bot.inflight.slow_count} slow so far. '
+        f'Shed: {stats["shed_queue"]} (queue full), {stats["shed_stale"]} '
+        f'(stale), {stats["coalesced"]} coalesced.')
+    for entry in entries[:10]:
+        upstream = f' on {entry.upstream}' if entry.upstream else ''
+        cancelled = ' (cancelled)' if entry.cancelled else ''
+        irc.msg(args[0], f'#{entry.id}: {entry.command!r} ({entry.type}) by '
+            f'{entry.user} in {entry.network}/{entry.channel}, running for '
+            f'{entry.elapsed:.1f}s{upstream}{cancelled}')
+
 # Get a tempcmd name
 def _get_tempcmd_name(bot, cmd):
     prefix = bot.cmd_db.prefix
@@ -100,21 +154,57 @@ def _get_tempcmd_name(bot, cmd):
 
     return cmd, r_cmd
 
-# Add and remove "tempcmds"
-@register_command('tempcmd', 'tempcmds', with_bot=True, requires_admin=True)
-def _cmd_tempcmd(bot, irc, hostmask, is_admin, args):
-    """
-    Creates a "tempcmd".
-    Usage: tempcmd del <command>
-    """
+# List and search tempcmds, pages are filled with as many names as fit in a
+#   message.
+def _list_tempcmds(bot, irc, hostmask, args, params, namespace):
+    words = ' '.join(params[1:]).split(' ')
+    page = 1
+    if len(words) > 1 and words[-2] == 'page' and words[-1].isdigit():
+        page = max(int(words[-1]), 1)
+        del words[-2:]
 
-    tempcmd_db = bot.cmd_db
-    assert tempcmd_db
+    if len(words) > 1:
+        return irc.msg(args[0], hostmask[0] + ': Invalid syntax!')
 
-    # Handle the arguments
-    cmd_type = None
-    params = args[-1].split(' ', 2)
+    query = _get_tempcmd_name(bot, words[0])[0] if words else ''
+    if params[0] == 'search' and not query:
+        return irc.msg(args[0], hostmask[0] + ': Invalid syntax!')
 
+    # Leave room for the header (with up to 7 digit numbers)
+    width = tempcmds._max_length(irc) - len(f'{hostmask[0]}: 0000000 tempcmds '
+                                            f'(page 0000000/0000000): ')
+    names, pages, total = bot.cmd_db.page(query, page, width,
+        search=params[0] == 'search', namespace=namespace)
+
+    if not names:
+        if total:
+            return irc.msg(args[0], f'{hostmask[0]}: Page {page} does not '
+                'exist!')
+        return irc.msg(args[0], hostmask[0] + ': No tempcmds found.')
+
+    irc.msg(args[0], f'{hostmask[0]}: {total} tempcmd'
+        f'{"" if total == 1 else "s"} (page {page}/{pages}): '
+        + ', '.join(names))
+
+# Get the tempcmd namespace for a scope, returns the namespace and a
+#   description of it (or None if the scope is invalid).
+def _get_tempcmd_namespace(bot, irc, channel, scope):
+    if scope == '@global':
+        return None, ''
+
+    network, channel = bot._namespace(irc, bot._prefs.get(irc), channel)
+    if scope == '@network':
+        return (network, None), f' on {network}'
+    elif scope == '@channel' and channel:
+        return (network, channel), f' in {channel}'
+
+    return None, None
+
+# Split tempcmd arguments into the command name, type and code. The type is
+#   None if it was not specified and "add" was not used, returns None if the
+#   syntax is invalid.
+def _split_tempcmd_args(params):
+    cmd_type = None
     if len(params) > 1 and params[0] == 'add':
         cmd_type = False
 
@@ -131,7 +221,126 @@ def _cmd_tempcmd(bot, irc, hostmask, is_admin, args):
     elif len(params) == 2:
         cmd, code = params
     else:
+        return None
+
+    return cmd, cmd_type, code
+
+# Apply several tempcmd changes at once, either all of the changes are made or
+#   none of them are.
+def _batch_tempcmds(bot, irc, hostmask, is_admin, args, text, namespace,
+        where):
+    tempcmd_db = bot.cmd_db
+    exists = {}
+    changes = []
+    for i, change in enumerate(text.split(' ;; '), 1):
+        change = change.strip(' ')
+        c_namespace, c_where = namespace, where
+        if change.startswith('@'):
+            scope, _, change = change.partition(' ')
+            c_namespace, c_where = _get_tempcmd_namespace(bot, irc, args[0],
+                                                          scope.lower())
+            if c_where is None:
+                return irc.msg(args[0], f'{hostmask[0]}: Change {i}: Invalid '
+                    f'scope {scope!r}!')
+
+        res = _split_tempcmd_args(change.split(' ', 2))
+        if res is None:
+            return irc.msg(args[0], f'{hostmask[0]}: Change {i}: Invalid '
+                'syntax!')
+        cmd, cmd_type, code = res
+
+        # Earlier changes in the batch are taken into account.
+        if cmd_type is None and cmd in ('del', 'delete', 'remove'):
+            cmd, r_cmd = _get_tempcmd_name(bot, code)
+            key = (c_namespace, cmd.lower())
+            if not exists.get(key, tempcmd_db.defines(cmd,
+                                                      namespace=c_namespace)):
+                return irc.msg(args[0], f'{hostmask[0]}: Change {i}: The '
+                    f'command {r_cmd} does not exist or is not a '
+                    f'tempcmd{c_where}!')
+            exists[key] = False
+            changes.append((c_namespace, c_where, cmd, r_cmd, None, None,
+                            'deleted'))
+            continue
+
+        cmd, r_cmd = _get_tempcmd_name(bot, cmd)
+        if cmd.lower() in commands:
+            return irc.msg(args[0], f'{hostmask[0]}: Change {i}: The command '
+                f'{r_cmd} already exists as a normal command!')
+
+        key = (c_namespace, cmd.lower())
+        verb = 'updated' if exists.get(key, tempcmd_db.defines(cmd,
+            namespace=c_namespace)) else 'created'
+        exists[key] = True
+        c = {'code': code}
+        if cmd_type:
+            c['type'] = cmd_type
+        changes.append((c_namespace, c_where, cmd, r_cmd,
+                        tempcmds.Command(c), code, verb))
+
+    with tempcmd_db.transaction() as txn:
+        for c_namespace, _, cmd, _, command, _, _ in changes:
+            txn.set(cmd, command, namespace=c_namespace)
+
+    summary = []
+    for _, c_where, cmd, r_cmd, command, code, verb in changes:
+        if command is None:
+            bot._audit('tempcmd', irc, hostmask, args[0], cmd,
+                       'deleted' + c_where)
+        else:
+            bot._audit('tempcmd', irc, hostmask, args[0], cmd,
+                       f'{verb}{c_where} ({command.type}): {code}')
+        summary.append(f'{verb} {r_cmd}{c_where}')
+
+    summary = ', '.join(summary)
+    log = bot._prefs.get(irc, {}).get('tempcmd_log')
+    if log:
+        irc.msg(log, f'User {is_admin!r} changed {len(changes)} temporary '
+            f'command{"" if len(changes) == 1 else "s"}: {summary}.')
+    irc.msg(args[0], f'{hostmask[0]}: Applied {len(changes)} change'
+        f'{"" if len(changes) == 1 else "s"}: {summary}.')
+
+# Add and remove "tempcmds"
+@register_command('tempcmd', 'tempcmds', with_bot=True, requires_admin=True)
+def _cmd_tempcmd(bot, irc, hostmask, is_admin, args):
+    """
+    Creates a "tempcmd".
+    Usage: tempcmd del <command>
+           tempcmd list [prefix] [page <n>]
+           tempcmd search <text> [page <n>]
+           tempcmd batch <change> ;; <change> ;; ...
+    Prefix any of these with @channel or @network to use the current
+      channel's or network's tempcmds.
+    """
+
+    tempcmd_db = bot.cmd_db
+    assert tempcmd_db
+
+    # Handle namespaces
+    namespace, where = None, ''
+    text = args[-1]
+    if text.startswith('@'):
+        scope, _, text = text.partition(' ')
+        namespace, where = _get_tempcmd_namespace(bot, irc, args[0],
+                                                  scope.lower())
+        if where is None:
+            return irc.msg(args[0], f'{hostmask[0]}: Invalid scope {scope!r}!'
+                ' Use @global, @network or @channel (in channels).')
+
+    # Handle the arguments
+    params = text.split(' ', 2)
+
+    if params[0] in ('list', 'search'):
+        return _list_tempcmds(bot, irc, hostmask, args, params, namespace)
+
+    if len(params) > 1 and params[0] == 'batch':
+        return _batch_tempcmds(bot, irc, hostmask, is_admin, args,
+                               text.split(' ', 1)[1], namespace, where)
+
+    res = _split_tempcmd_args(params)
+    if res is None:
         return irc.msg(args[0], hostmask[0] + ': Invalid syntax!')
+    cmd, cmd_type, code = res
 
     log = bot._prefs.get(irc, {}).get('tempcmd_log')
 
@@ -139,28 +348,31 @@ def _cmd_tempcmd(bot, irc, hostmask, is_admin, args):
     if cmd_type is None and cmd == 'info':
         cmd, r_cmd = _get_tempcmd_name(bot, code)
 
-        if cmd not in tempcmd_db:
+        # Only commands defined in the scope itself are shown.
+        data = tempcmd_db.defines(cmd, namespace=namespace) and \
+            tempcmd_db.get(cmd, allowed_aliases=0, namespace=namespace)
+        if not data:
             return irc.msg(args[0], hostmask[0] + ': The command '
-                + r_cmd + ' does not exist or is not a tempcmd!')
-
-        data = tempcmd_db.get(cmd, allowed_aliases=0)
+                + r_cmd + ' does not exist or is not a tempcmd' + where + '!')
 
         return irc.msg(args[0], f'{hostmask[0]}: The command {r_cmd} is a '
-            f'{data.type!r} tempcmd.\nCode: `{data.code}`')
+            f'{data.type!r} tempcmd{where}.\nCode: `{data.code}`')
 
     # Delete tempcmds
     if cmd_type is None and cmd in ('del', 'delete', 'remove'):
         cmd, r_cmd = _get_tempcmd_name(bot, code)
 
-        if cmd not in tempcmd_db:
+        if not tempcmd_db.defines(cmd, namespace=namespace):
             return irc.msg(args[0], hostmask[0] + ': The command '
-                + r_cmd + ' does not exist or is not a tempcmd!')
+                + r_cmd + ' does not exist or is not a tempcmd' + where + '!')
 
-        del tempcmd_db[cmd]
+        tempcmd_db.delete(cmd, namespace=namespace)
+        bot._audit('tempcmd', irc, hostmask, args[0], cmd, 'deleted' + where)
         if log:
             irc.msg(log, f'User {is_admin!r} deleted temporary command '
-                f'{r_cmd}.')
-        irc.msg(args[0], hostmask[0] + ': Command ' + r_cmd + ' deleted.')
+                f'{r_cmd}{where}.')
+        irc.msg(args[0], hostmask[0] + ': Command ' + r_cmd + ' deleted' +
+            where + '.')
         return
 
     # Make sure the command does not start with the prefix
@@ -172,19 +384,23 @@ def _cmd_tempcmd(bot, irc, hostmask, is_admin, args):
             ' already exists as a normal command!')
 
     # Add the command
-    verb = 'updated' if cmd in tempcmd_db else 'created'
+    verb = 'updated' if tempcmd_db.defines(cmd, namespace=namespace) else \
+        'created'
     c = {'code': code}
     if cmd_type:
         c['type'] = cmd_type
-    tempcmd_db[cmd] = c
+    tempcmd_db.set(cmd, c, namespace=namespace)
 
     # Get the type
     if not cmd_type:
-        cmd_type = tempcmd_db.get(cmd, allowed_aliases=0).type
+        cmd_type = tempcmd_db.get(cmd, allowed_aliases=0,
+                                  namespace=namespace).type
 
     # Return the message
+    bot._audit('tempcmd', irc, hostmask, args[0], cmd,
+               f'{verb}{where} ({cmd_type}): {code}')
     if log:
-        irc.msg(log, f'User {is_admin!r} {verb} temporary command {r_cmd} '
-            f'(of type {cmd_type!r}): {code!r}')
+        irc.msg(log, f'User {is_admin!r} {verb} temporary command {r_cmd}'
+            f'{where} (of type {cmd_type!r}): {code!r}')
     irc.msg(args[0], f'{hostmask[0]}: Command {r_cmd} (of type {cmd_type!r}) '
-        f'{verb}.')
+        f'{verb}{where}.')
@@ -3,7 +3,8 @@
 # Command handler - Processes commands
 #
 
-import json, os, re, threading, time, urllib.request, urllib.parse
+import bisect, codecs, json, os, re, string, threading, time, urllib.parse
+import lurklite.inflight as inflight, lurklite.snapshot as snapshot
 
 def web_quote(string):
     return urllib.parse.quote(string, '')
@@ -19,10 +20,13 @@ except ImportError:
 _command_types = {}
 _command_ids   = {}
 _unknown_regex = []
+_guess_regex   = None
 def register_command_type(type_, use_config=False, *, unknown_re=None,
         _hex=None):
+    global _guess_regex
     if unknown_re:
         _unknown_regex.insert(0, (re.compile(unknown_re), type_))
+        _guess_regex = None
 
     if type(_hex) == int:
         _command_ids[_hex] = type_
@@ -35,13 +39,54 @@ def register_command_type(type_, use_config=False, *, unknown_re=None,
 
     return n
 
+# Combine the unknown_re patterns into one RegEx with a named group for each
+#   type, patterns are tried in the same order as _unknown_regex. Returns the
+#   RegEx and a list of types, or False if the patterns can't be combined (for
+#   example if they use backreferences, which would be renumbered).
+def _compile_guess_regex():
+    parts = []
+    types = []
+    for i, (regex, type_) in enumerate(_unknown_regex):
+        if re.search(r'\\[0-9]|\(\?P=|\(\?[a-zA-Z]+\)', regex.pattern):
+            return False
+        parts.append(f'(?P<_t{i}>{regex.pattern})')
+        types.append(type_)
+
+    try:
+        return (re.compile('|'.join(parts)), types) if parts else False
+    except re.error:
+        return False
+
+# Guess the type of a command from its code, returns None if no types match.
+def guess_command_type(code):
+    global _guess_regex
+    regex = _guess_regex
+    if regex is None:
+        regex = _guess_regex = _compile_guess_regex()
+
+    if regex:
+        regex, types = regex
+        match = regex.match(code)
+        return match and types[int(match.lastgroup[2:])]
+
+    for regex, type_ in _unknown_regex:
+        if regex.match(code):
+            return type_
+    return None
+
+# Get the maximum length of a command's output
+def _max_length(irc):
+    if hasattr(irc, 'msglen'):
+        return irc.msglen - 112
+    return 400
+
 # Check if a command type exists
 def command_type_exists(cmd_type):
     return cmd_type in _command_types
 
 # Run a command
 def _run_raw_command(cmd_type, code, irc, hostmask, channel, args, *,
-        config={}, reply_prefix=None):
+        config={}, reply_prefix=None, on_error=None):
     try:
         assert cmd_type in _command_types, 'Invalid command type!'
         handler = _command_types[cmd_type]
@@ -49,6 +94,7 @@ def _run_raw_command(cmd_type, code, irc, hostmask, channel, args, *,
             res = handler(irc, hostmask, channel, code, config, args)
         else:
             res = handler(irc, hostmask, channel, code, args)
+        inflight.check_cancelled()
 
         # Sanity check
         assert type(res) == str, 'The command handler did not return a string!'
@@ -61,11 +107,7 @@ def _run_raw_command(cmd_type, code, irc, hostmask, channel, args, *,
             action = False
 
         # Make sure the result is a sane length
-        if hasattr(irc, 'msglen'):
-            maxlen = irc.msglen - 112
-        else:
-            maxlen = 400
-
+        maxlen = _max_length(irc)
         if len(res) > maxlen:
             res = res[:maxlen] + '...'
 
@@ -84,9 +126,25 @@ def _run_raw_command(cmd_type, code, irc, hostmask, channel, args, *,
     except Exception as err:
         irc.notice(channel, '\x034Error running command!\x0f\n' \
             '{}: {}'.format(type(err).__name__, err))
+        if on_error:
+            on_error(f'{type(err).__name__}: {err}')
         if irc.debug_file:
             raise
 
+# Check if a command's output can depend on who ran it
+_caller_fields = frozenset(('nick', 'NICK', 'host', 'hostmask'))
+def depends_on_caller(command):
+    # lambda and nodejs commands are always given the caller's hostmask.
+    if command.type in ('lambda', 'nodejs'):
+        return True
+
+    try:
+        fields = string.Formatter().parse(command.code)
+        return any(re.match(r'[^.\[]*', field)[0] in _caller_fields
+                   for _, field, _, _ in fields if field)
+    except ValueError:
+        return True
+
 # Command class
 class Command:
     type   = 'string'
@@ -113,9 +171,11 @@ class Command:
             'code': self.code
         }
 
-    def __call__(self, irc, hostmask, args, *, reply_prefix=None):
+    def __call__(self, irc, hostmask, args, *, reply_prefix=None,
+            on_error=None):
         return _run_raw_command(self.type, self.code, irc, hostmask, args[0],
-            args[1:], config=self.config, reply_prefix=reply_prefix)
+            args[1:], config=self.config, reply_prefix=reply_prefix,
+            on_error=on_error)
 
     def __init__(self, cmdinfo={}, **kwargs):
         if type(cmdinfo) in (list, tuple) and len(cmdinfo) == 3:
@@ -135,15 +195,246 @@ class Command:
                 self.type = _command_ids.get(self.type)
         else:
             # Try and guess the command type
-            for d in _unknown_regex:
-                if d[0].match(self.code):
-                    self.type = d[1]
-                    break
+            cmd_type = guess_command_type(self.code)
+            if cmd_type:
+                self.type = cmd_type
+
+
+# A sorted index of command names so that tempcmds can be listed and searched
+#   without scanning the whole database. Substring searches use a sorted list
+#   of (suffix, name) pairs.
+class _NameIndex:
+    def __init__(self, names=()):
+        names = {_strip_legacy(name) for name in names}
+        self.names = sorted(names)
+        self.suffixes = sorted((name[i:], name) for name in names
+                               for i in range(len(name)))
+        self._pages = {}
+
+    def add(self, name):
+        i = bisect.bisect_left(self.names, name)
+        if i < len(self.names) and self.names[i] == name:
+            return
+        self.names.insert(i, name)
+        for j in range(len(name)):
+            bisect.insort(self.suffixes, (name[j:], name))
+        self._pages.clear()
+
+    def remove(self, name):
+        i = bisect.bisect_left(self.names, name)
+        if i >= len(self.names) or self.names[i] != name:
+            return
+        del self.names[i]
+        for j in range(len(name)):
+            k = bisect.bisect_left(self.suffixes, (name[j:], name))
+            del self.suffixes[k]
+        self._pages.clear()
+
+    # Get all names starting with prefix
+    def with_prefix(self, prefix, offset=0, limit=None):
+        lo = bisect.bisect_left(self.names, prefix)
+        if prefix:
+            upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            hi = bisect.bisect_left(self.names, upper, lo)
+        else:
+            hi = len(self.names)
+
+        start = lo + offset
+        end = hi if limit is None else min(start + limit, hi)
+        return self.names[start:end], max(hi - lo, 0)
+
+    # Get all names containing substring
+    def containing(self, substring, offset=0, limit=None):
+        if not substring:
+            return self.with_prefix('', offset, limit)
+
+        res = set()
+        suffixes = self.suffixes
+        i = bisect.bisect_left(suffixes, (substring,))
+        while i < len(suffixes) and suffixes[i][0].startswith(substring):
+            res.add(suffixes[i][1])
+            i += 1
+
+        res = sorted(res)
+        end = None if limit is None else offset + limit
+        return res[offset:end], len(res)
+
+    # Get a page of names starting with (or containing, if search is true)
+    #   query. Pages are filled with names (separated by ", ") up to width
+    #   characters, and page boundaries are cached until the index changes.
+    #   Returns the names, the number of pages and the total number of names.
+    def page(self, query, page, width, *, search=False):
+        key = (search, query, width)
+        cached = self._pages.get(key)
+        if cached is None:
+            if search:
+                names, total = self.containing(query)
+            else:
+                names, total = self.with_prefix(query)
+
+            starts = [0]
+            length = -2
+            for i, name in enumerate(names):
+                if i > starts[-1] and length + 2 + len(name) > width:
+                    starts.append(i)
+                    length = len(name)
+                else:
+                    length += 2 + len(name)
+
+            if len(self._pages) >= 64:
+                self._pages.clear()
+
+            # Substring search results aren't contiguous in the index.
+            cached = self._pages[key] = (starts, total,
+                                         names if search else None)
+
+        starts, total, names = cached
+        if not total or page > len(starts):
+            return [], len(starts), total
+
+        start = starts[page - 1]
+        end = starts[page] if page < len(starts) else total
+        if names is None:
+            names = self.with_prefix(query, start, end - start)[0]
+        else:
+            names = names[start:end]
+        return names, len(starts), total
+
+def _strip_legacy(name):
+    return name[1:] if name.startswith('µ') else name
+
+# Normalise a (network, channel) namespace, the global namespace is None.
+def _namespace(namespace):
+    if namespace is None or namespace[0] is None:
+        return None
+    network, channel = namespace
+    return network, channel.lower() if channel else None
+
+# A single layer of the command database (the global commands or the commands
+#   for one network or channel), each layer is stored in its own file.
+class _Layer:
+    def __init__(self, location):
+        self.location = location
+        self.data     = {}
+        self.index    = None
+        self.stat     = None
+
+    def __repr__(self):
+        return 'tempcmds._Layer(' + repr(self.location) + ')'
+
+    # Check if the file has changed since it was last read
+    def changed(self):
+        st = os.stat(self.location)
+        return (st.st_ino, st.st_mtime_ns, st.st_size) != self.stat
+
+    def load(self):
+        with open(self.location, 'rb') as f:
+            st = os.fstat(f.fileno())
+            data = f.read(len(snapshot.MAGIC))
+            if snapshot.is_snapshot(data):
+                # Snapshots are mmap()ed rather than read.
+                self.data = snapshot.Snapshot(self.location, f)
+            else:
+                data += f.read()
+                if not msgpack or data.startswith(b'{'):
+                    self.data = json.loads(data.decode('utf-8', 'replace'))
+                else:
+                    self.data = msgpack.loads(data, raw=False)
+
+        self.stat = (st.st_ino, st.st_mtime_ns, st.st_size)
+        self.index = None
+
+    # Write data to a temporary file, returns the file's path. The file can be
+    #   moved into place with replace().
+    def stage(self, data, db_format):
+        if db_format == 'snapshot':
+            chunks = snapshot.encode(data)
+        elif msgpack and db_format != 'json':
+            chunks = [msgpack.dumps(data)]
+        else:
+            chunks = [json.dumps(data).encode('utf-8')]
+        return snapshot.write_temp(self.location, chunks, prefix='.commands-')
+
+    # Replace the file with one from stage(), the file is replaced atomically
+    #   so that other processes never see a partially written database.
+    def replace(self, tmp, data, db_format):
+        os.replace(tmp, self.location)
+        if db_format == 'snapshot':
+            # Snapshots are mmap()ed rather than kept in memory.
+            self.load()
+            return
+
+        st = os.stat(self.location)
+        self.stat = (st.st_ino, st.st_mtime_ns, st.st_size)
+        self.data = data
+
+    def save(self, data, db_format):
+        tmp = self.stage(data, db_format)
+        try:
+            self.replace(tmp, data, db_format)
+        finally:
+            snapshot.remove_temp(tmp)
+
+# The commands from network and channel layers on top of the global layer.
+#   Only the (small) network and channel layers are copied, the global layer
+#   is used as-is so that snapshots stay mmap()ed.
+class _Overlay:
+    def __init__(self, overrides, base):
+        self.overrides = overrides
+        self.base      = base
+
+    def __repr__(self):
+        return f'<tempcmds._Overlay of {len(self.overrides)} command(s)>'
+
+    def get(self, key, default=None):
+        res = self.overrides.get(key)
+        if res is None:
+            return self.base.get(key, default)
+        return res
+
+    def __getitem__(self, key):
+        res = self.overrides.get(key)
+        if res is None:
+            return self.base[key]
+        return res
+
+    def __contains__(self, key):
+        return key in self.overrides or key in self.base
+
+    def __iter__(self):
+        yield from self.overrides
+        for key in self.base:
+            if key not in self.overrides:
+                yield key
+
+    def keys(self):
+        return iter(self)
 
+    def items(self):
+        for key in self:
+            yield key, self[key]
 
 # Command database
+#
+# Commands are stored in layers: the global layer (in location) and optional
+#   per-network and per-channel layers (in location + '.d'). Lookups in a
+#   namespace go through an overlay of the layers that exist for it, overlays
+#   are shared between namespaces with the same layers (so channels without
+#   their own commands use the network's overlay).
 class CommandDatabase:
     _next_update = 0
+    _scheduled   = False
+
+    # If set, audit(event, irc, hostmask, channel, command, detail) is called
+    #   when commands are run or fail.
+    audit = None
+
+    # If set, track(irc, hostmask, channel, command, type) is used as a context
+    #   manager while commands are running.
+    track = None
+
+    # A replication.Journal that records changes (see attach_journal()).
+    journal = None
 
     def __init__(self, location='commands.db', prefix=None, *,
             reply_on_invalid=False, update_interval=10, config={},
@@ -151,11 +442,18 @@ class CommandDatabase:
         self.location         = location
         self.reply_on_invalid = reply_on_invalid
         self.prefix           = prefix or '{}|'.format(os.getpid())
-        self._config          = config
-        self._data            = {}
+        self._layer_dir       = location + '.d'
+        self._layers          = {None: _Layer(location)}
+        self._overlays        = {}
         self._lock            = threading.Lock()
         self._update_interval = update_interval
 
+        self.set_config(config)
+
+    # Update the [tempcmds] config
+    def set_config(self, config):
+        self._config = config
+
         # Note that the database format is auto-detected on load, this only
         # modifies the format used to save the database.
         self.db_format = config.get('db_format', 'msgpack').lower()
@@ -163,35 +461,136 @@ class CommandDatabase:
     def __repr__(self):
         return 'tempcmds.CommandDatabase(' + repr(self.location) + ')'
 
+    # Get the file a layer is stored in
+    def _layer_location(self, namespace):
+        if namespace is None:
+            return self.location
+
+        network, channel = namespace
+        location = os.path.join(self._layer_dir, web_quote(network))
+        if channel is None:
+            return location + '.db'
+        return os.path.join(location, web_quote(channel) + '.db')
+
+    # Find the network and channel layers on disk
+    def _find_layers(self):
+        res = {None}
+        try:
+            entries = list(os.scandir(self._layer_dir))
+        except FileNotFoundError:
+            return res
+
+        unquote = urllib.parse.unquote
+        for entry in entries:
+            if entry.is_dir():
+                network = unquote(entry.name)
+                for channel in os.scandir(entry.path):
+                    if channel.name.endswith('.db'):
+                        res.add((network, unquote(channel.name[:-3])))
+            elif entry.name.endswith('.db'):
+                res.add((unquote(entry.name[:-3]), None))
+        return res
+
+    # Forget overlays, this must be called with the lock held.
+    def _invalidate(self):
+        self._overlays = {}
+
     # Update the database
     def _update(self, *, force=False):
         if not force and self._next_update > time.time():
             return
 
         with self._lock:
+            changed = False
             try:
-                with open(self.location, 'rb') as f:
-                    data = f.read()
-                    if not msgpack or data.startswith(b'{'):
-                        self._data = json.loads(data.decode('utf-8',
-                                                            'replace'))
-                    else:
-                        self._data = msgpack.loads(data, raw=False)
-            except Exception as e:
-                print('WARNING: Unable to read commands database!', repr(e))
+                found = self._find_layers()
+            except OSError as e:
+                print('WARNING: Unable to list tempcmd namespaces!', repr(e))
+                found = set(self._layers)
+
+            for namespace in list(self._layers):
+                if namespace not in found:
+                    del self._layers[namespace]
+                    changed = True
+
+            # Layers are only re-read if their file has changed.
+            for namespace in found:
+                layer = self._layers.get(namespace)
+                if layer is None:
+                    layer = _Layer(self._layer_location(namespace))
+                    self._layers[namespace] = layer
+                try:
+                    if layer.changed():
+                        layer.load()
+                        changed = True
+                except Exception as e:
+                    print('WARNING: Unable to read commands database!',
+                          repr(e))
+
+            if changed:
+                self._invalidate()
+
+            if self._scheduled:
+                self._next_update = float('inf')
+            else:
+                self._next_update = time.time() + self._update_interval
+
+    # Reload the database periodically from a scheduler.Scheduler instead of
+    #   when commands are looked up. The first lookup still loads the database
+    #   if the scheduler has not done so yet.
+    def schedule(self, scheduler):
+        self._scheduled = True
+        if self._next_update:
+            self._next_update = float('inf')
+        return scheduler.call_every(self._update_interval, self.reload)
+
+    def reload(self):
+        self._update(force=True)
+
+    # Get the layers that exist for a namespace (most specific last)
+    def _chain(self, namespace):
+        key = _namespace(namespace)
+        if key is None:
+            return (None,)
+
+        chain = (None,)
+        network = (key[0], None)
+        if network in self._layers:
+            chain += (network,)
+        if key[1] is not None and key in self._layers:
+            chain += (key,)
+        return chain
+
+    # Get the overlay for a chain of layers, overlays are cached until a
+    #   layer changes.
+    def _overlay(self, chain):
+        data = self._overlays.get(chain)
+        if data is not None:
+            return data
+
+        with self._lock:
+            layers = [self._layers[n] for n in chain if n in self._layers]
+            data = layers[0].data
+            if len(layers) > 1:
+                overrides = {}
+                for layer in layers[1:]:
+                    overrides.update(layer.data.items())
+                data = _Overlay(overrides, data)
 
-            self._next_update = time.time() + self._update_interval
+            self._overlays[chain] = data
+            return data
 
     # Get commands
-    def get(self, item, *, allowed_aliases=10):
+    def get(self, item, *, allowed_aliases=10, namespace=None):
         self._update()
+        data = self._overlay(self._chain(namespace))
         item = item.lower()
-        res  = self._data.get(item)
+        res  = data.get(item)
 
         # Backwards-compatibility weirdness
-        if not res and 'µ' + item in self._data:
+        if not res and 'µ' + item in data:
             item = 'µ' + item
-            res  = self._data[item]
+            res  = data[item]
 
         # Convert the command dict/str to a Command object and resolve aliases.
         if res:
@@ -202,7 +601,8 @@ class CommandDatabase:
                 if res.code.startswith('.'):
                     res.code = res.code[1:]
 
-                return self.get(res.code, allowed_aliases=allowed_aliases - 1)
+                return self.get(res.code, allowed_aliases=allowed_aliases - 1,
+                                namespace=namespace)
 
         return res
 
@@ -214,59 +614,289 @@ class CommandDatabase:
 
     def __contains__(self, item):
         self._update()
+        data = self._overlay((None,))
+        item = item.lower()
+        return item in data or 'µ' + item in data
+
+    # Check if a command is defined in a namespace's own layer (rather than
+    #   inherited from the network or global layers).
+    def defines(self, item, *, namespace=None):
+        self._update()
+        layer = self._layers.get(_namespace(namespace))
         item = item.lower()
-        return item in self._data or 'µ' + item in self._data
+        return layer is not None and (item in layer.data or
+                                      'µ' + item in layer.data)
+
+    # Set commands, namespaced commands are stored in the most specific layer
+    #   of the namespace.
+    def set(self, item, value, *, namespace=None):
+        with self.transaction() as txn:
+            txn.set(item, value, namespace=namespace)
 
-    # Set commands
     def __setitem__(self, item, value):
-        if type(value) == dict:
-            value = Command(value)
+        self.set(item, value)
 
-        assert value is None or isinstance(value, Command)
+    def delete(self, item, *, namespace=None):
+        self.set(item, None, namespace=namespace)
 
-        item = item.lower()
-        value = value and value.as_list()
+    # Start a batch of changes (see Transaction)
+    def transaction(self):
+        return Transaction(self)
 
+    # Apply (namespace, item, value) changes from a transaction
+    def _commit(self, changes):
         self._update(force=True)
 
         with self._lock:
-            # Delete "legacy" µcommands
-            if 'µ' + item in self._data:
-                del self._data['µ' + item]
+            self._write_changes(changes)
+            if self.journal:
+                self.journal.record_local([(_journal_key(namespace, item),
+                    value) for namespace, item, value in changes])
+
+    # Apply (namespace, item, value) changes and save the affected layers,
+    #   this must be called with the lock held. Every affected layer is
+    #   written to a temporary file before any of them are replaced, and
+    #   lookups only see the changes once every layer has been replaced.
+    def _write_changes(self, changes):
+        by_layer = {}
+        for namespace, item, value in changes:
+            by_layer.setdefault(namespace, []).append((item, value))
+
+        staged = []
+        try:
+            for namespace, layer_changes in by_layer.items():
+                layer = self._layers.get(namespace)
+                if layer is None:
+                    layer = _Layer(self._layer_location(namespace))
 
-            if value is None:
-                if item in self._data:
-                    del self._data[item]
-            else:
-                self._data[item] = value
+                data = dict(layer.data.items())
 
-            if msgpack and self.db_format != 'json':
-                with open(self.location, 'wb') as f:
-                    f.write(msgpack.dumps(self._data))
-            else:
-                with open(self.location, 'w') as f:
-                    f.write(json.dumps(self._data))
+                for item, value in layer_changes:
+                    # Delete "legacy" µcommands
+                    if 'µ' + item in data:
+                        del data['µ' + item]
+
+                    if value is None:
+                        if item in data:
+                            del data[item]
+                    else:
+                        data[item] = value
+
+                # Empty network and channel layers are removed.
+                tmp = None
+                if namespace is None or data:
+                    os.makedirs(os.path.dirname(os.path.abspath(
+                        layer.location)), exist_ok=True)
+                    tmp = layer.stage(data, self.db_format)
+                elif namespace not in self._layers:
+                    continue
+
+                staged.append((namespace, layer, tmp, data, layer_changes,
+                               layer.data, layer.index))
+        except BaseException:
+            for _, _, tmp, *_ in staged:
+                if tmp:
+                    snapshot.remove_temp(tmp)
+            raise
+
+        # Replace the layers, the ones that have already been replaced are
+        #   restored if this fails part way through.
+        done = []
+        try:
+            for namespace, layer, tmp, data, *_, old_data, _ in staged:
+                existed = namespace in self._layers
+                if tmp is None:
+                    os.remove(layer.location)
+                    del self._layers[namespace]
+                else:
+                    layer.replace(tmp, data, self.db_format)
+                    self._layers[namespace] = layer
+                done.append((namespace, layer, old_data, existed))
+        except BaseException:
+            self._restore_layers(done)
+            raise
+        finally:
+            for _, _, tmp, *_ in staged:
+                if tmp:
+                    snapshot.remove_temp(tmp)
+            self._invalidate()
+
+        # Update the name indexes instead of rebuilding them
+        for _, layer, tmp, _, layer_changes, _, index in staged:
+            if tmp and index:
+                for item, value in layer_changes:
+                    if value is None:
+                        index.remove(item)
+                    else:
+                        index.add(item)
+                layer.index = index
+
+    # Restore layers replaced by a failed _write_changes() call
+    def _restore_layers(self, done):
+        for namespace, layer, old_data, existed in reversed(done):
+            try:
+                if existed:
+                    layer.save(old_data, self.db_format)
+                    layer.index = None
+                    self._layers[namespace] = layer
+                else:
+                    os.remove(layer.location)
+                    self._layers.pop(namespace, None)
+            except Exception as e:
+                print('WARNING: Unable to restore tempcmd layer',
+                      repr(layer.location) + '!', repr(e))
+
+    # Attach a replication.Journal, existing commands are added to an empty
+    #   journal so that they can be replicated.
+    def attach_journal(self, journal):
+        self._update(force=True)
+        with self._lock:
+            self.journal = journal
+            if not journal.version:
+                journal.bootstrap([(_journal_key(namespace, item), value)
+                    for namespace, layer in self._layers.items()
+                    for item, value in layer.data.items()])
+
+    # Apply change records from another bot, changes older than the ones
+    #   already applied are ignored.
+    def apply_remote(self, records):
+        self._update(force=True)
+        with self._lock:
+            records = self.journal.newer(records)
+            if records:
+                self._write_changes([(*_split_journal_key(record.key),
+                                      record.value) for record in records])
+                self.journal.append(records)
+        return len(records)
+
+    # List and search the commands defined in a namespace's own layer (like
+    #   defines()), each layer's index is rebuilt lazily after it is reloaded.
+    def _query_index(self, namespace, func, *args):
+        self._update()
+        with self._lock:
+            layer = self._layers.get(_namespace(namespace))
+            if layer is None:
+                return func(_NameIndex(), *args)
+            if layer.index is None:
+                layer.index = _NameIndex(layer.data)
+            return func(layer.index, *args)
+
+    def names(self, prefix='', *, namespace=None):
+        return self._query_index(namespace, _NameIndex.with_prefix,
+                                 prefix.lower())
+
+    def search(self, substring, *, namespace=None):
+        return self._query_index(namespace, _NameIndex.containing,
+                                 substring.lower())
+
+    # Get a page of a listing or search (see _NameIndex.page())
+    def page(self, query, page, width, *, search=False, namespace=None):
+        return self._query_index(namespace, lambda index : index.page(
+            query.lower(), page, width, search=search))
 
     # Alias for deleting commands
     def __delitem__(self, item):
         self[item] = None
 
     # Handle function-like calls
-    def __call__(self, irc, hostmask, args, *, reply_prefix=None):
-        if args[-1].startswith(self.prefix):
+    def __call__(self, irc, hostmask, args, *, reply_prefix=None,
+            prefix=None, namespace=None):
+        prefix = prefix or self.prefix
+        if args[-1].startswith(prefix):
             cmd_args = args[-1].split(' ')
-            cmd      = cmd_args[0][len(self.prefix):]
+            cmd      = cmd_args[0][len(prefix):]
             cmd_args[0] = args[0]
             irc.debug(cmd, cmd_args)
 
-            if cmd in self:
-                self[cmd](irc, hostmask, cmd_args, reply_prefix=reply_prefix)
+            command = self.get(cmd, namespace=namespace)
+            if command:
+                on_error = None
+                if self.audit:
+                    self.audit('command', irc, hostmask, args[0], cmd,
+                               command.type)
+                    on_error = lambda err : self.audit('error', irc,
+                        hostmask, args[0], cmd, err)
+                if self.track:
+                    with self.track(irc, hostmask, args[0], cmd, command.type):
+                        command(irc, hostmask, cmd_args,
+                                reply_prefix=reply_prefix, on_error=on_error)
+                else:
+                    command(irc, hostmask, cmd_args, reply_prefix=reply_prefix,
+                            on_error=on_error)
             elif self.reply_on_invalid:
                 irc.msg(args[0], f'{hostmask[0]}: Invalid command: {cmd!r}')
             elif irc.debug_file:
                 irc.debug(f'User {hostmask} tried to execute invalid command '
                           f'{cmd!r}')
 
+# A batch of changes to a CommandDatabase that are saved together and become
+#   visible at the same time. Transactions can be used as context managers, in
+#   which case the changes are committed unless an exception is raised:
+#
+#   with cmd_db.transaction() as txn:
+#       txn['alias'] = {'type': 'alias', 'code': 'target'}
+#       txn['target'] = 'Hello world!'
+#       del txn['old']
+class Transaction:
+    def __init__(self, cmd_db):
+        self.cmd_db   = cmd_db
+        self._changes = {}
+
+    def __repr__(self):
+        return (f'<tempcmds.Transaction with {len(self._changes)} '
+                f'change(s)>')
+
+    def __len__(self):
+        return len(self._changes)
+
+    def set(self, item, value, *, namespace=None):
+        if type(value) in (dict, str):
+            value = Command(value)
+
+        assert value is None or isinstance(value, Command)
+
+        # Later changes to the same command replace earlier ones.
+        key = (_namespace(namespace), item.lower())
+        self._changes.pop(key, None)
+        self._changes[key] = value and value.as_list()
+
+    def delete(self, item, *, namespace=None):
+        self.set(item, None, namespace=namespace)
+
+    def __setitem__(self, item, value):
+        self.set(item, value)
+
+    def __delitem__(self, item):
+        self.set(item, None)
+
+    # Save the changes, a transaction can only be committed once.
+    def commit(self):
+        changes = [(namespace, item, value)
+                   for (namespace, item), value in self._changes.items()]
+        self._changes = None
+        if changes:
+            self.cmd_db._commit(changes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+# Namespaced commands are replicated with the network and channel in the key.
+def _journal_key(namespace, item):
+    if namespace is None:
+        return item
+    network, channel = namespace
+    return '\0'.join((network, channel or '', item))
+
+def _split_journal_key(key):
+    if '\0' not in key:
+        return None, key
+    network, channel, item = key.split('\0', 2)
+    return (network, channel or None), item
+
 # Handle format strings
 @register_command_type('string', _hex=0x00)
 def _command_string(irc, hostmask, channel, code, args):
@@ -294,18 +924,48 @@ def _command_action(irc, hostmask, channel, code, args):
 def _command_alias(irc, hostmask, channel, code, args):
     raise RecursionError('Maximum alias recursion depth exceeded.')
 
+# Read a URL as a stream, stopping once enough text has been received to fill
+#   a message (or once url_max_bytes bytes have been read). Returns the text
+#   and whether it was truncated.
+def _read_url(irc, url, config):
+    max_chars = _max_length(irc) + 16
+    max_bytes = config.get('url_max_bytes', 65536)
+
+    # urllib.request is slow to import, so it is only imported when needed.
+    import urllib.request
+
+    inflight.set_upstream(urllib.parse.urlsplit(url).hostname)
+    with urllib.request.urlopen(url, timeout=5) as res:
+        charset = res.headers.get_content_charset() or 'utf-8'
+        try:
+            decoder = codecs.getincrementaldecoder(charset)('replace')
+        except LookupError:
+            decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+        chunks = []
+        length = size = 0
+        while length < max_chars and size < max_bytes:
+            inflight.check_cancelled()
+            chunk = res.read(min(4096, max_bytes - size))
+            if not chunk:
+                chunks.append(decoder.decode(b'', True))
+                return ''.join(chunks), False
+            size += len(chunk)
+            chunk = decoder.decode(chunk)
+            chunks.append(chunk)
+            length += len(chunk)
+
+    return ''.join(chunks), True
+
 # Handle URLs
-@register_command_type('url', unknown_re='https://', _hex=0x03)
-def _command_url(irc, hostmask, channel, code, args):
+@register_command_type('url', True, unknown_re='https://', _hex=0x03)
+def _command_url(irc, hostmask, channel, code, config, args):
     assert code.startswith('http://') or code.startswith('https://')
 
     code = code.format(*[web_quote(a) for a in args],
         args = web_quote(' '.join(args)), nick = web_quote(hostmask[0]))
 
-    with urllib.request.urlopen(code, timeout=5) as res:
-        data = res.read().decode('utf-8', 'replace')
-
-    return data.rstrip('\r\n')
+    return _read_url(irc, code, config)[0].rstrip('\r\n')
 
 # Remotely execute Python2 lambdas
 @register_command_type('lambda', True, unknown_re='lambda', _hex=0x04)
@@ -318,8 +978,8 @@ def _command_lambda(irc, hostmask, channel, code, config, args):
             f'; hostmask = {hostmask}; print("|", ({code}){tuple(args)}, "|")')
     lambda_url = config.get('lambda_url',
         'https://tumbolia-two.appspot.com/py/')
-    code = lambda_url + web_quote(code)
-    res = _command_url(irc, hostmask, channel, code, args)
+    res, truncated = _read_url(irc, lambda_url + web_quote(code), config)
+    res = res.rstrip('\r\n')
 
     # Horrible workaround
     if lambda_url == 'https://tumbolia-two.appspot.com/py/':
@@ -332,6 +992,8 @@ def _command_lambda(irc, hostmask, channel, code, config, args):
         res = 'Invalid syntax! This command ' + res[22:] + '.'
     elif res.startswith('| ') and res.endswith(' |'):
         res = res[2:-2]
+    elif res.startswith('| ') and truncated:
+        res = res[2:]
 
     return res
 
@@ -342,4 +1004,4 @@ def _command_nodejs(irc, hostmask, channel, code, config, args):
     baseurl = config.get('nodejs_url', 'https://untitled-2khw8qubudu1.runkit.sh/')
     code = (f'{baseurl}?code={code}&nick={web_quote(hostmask[0])}'
             f'&channel={web_quote(channel)}&host={web_quote(hostmask[-1])}')
-    return _command_url(irc, hostmask, channel, code, args)
+    return _read_url(irc, code, config)[0].rstrip('\r\n')
@@ -0,0 +1,293 @@
+#!/usr/bin/python3
+#
+# Traffic recording and replay - Captures incoming PRIVMSGs and INVITEs and
+#   replays them against a bot with fake transports for load testing.
+#
+
+import argparse, collections, concurrent.futures, configparser, http.server, \
+    json, miniirc, os, shutil, tempfile, threading, time, urllib.request
+import lurklite.core as core, lurklite.tempcmds as tempcmds
+
+# Records events as JSON lines: [time, network, event, hostmask, args]
+class Recorder:
+    def __init__(self, location):
+        self.location = location
+        self._file    = open(location, 'a', encoding='utf-8')
+        self._lock    = threading.Lock()
+
+    def __repr__(self):
+        return 'traffic.Recorder(' + repr(self.location) + ')'
+
+    def record(self, network, event, hostmask, args):
+        line = json.dumps([time.time(), network, event, hostmask, args],
+                          separators=(',', ':')) + '\n'
+        with self._lock:
+            self._file.write(line)
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+# Read events from a recording
+def read_recording(location):
+    with open(location, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+# A fake miniirc transport, sent lines go through a simulated send queue that
+#   is drained at send_rate lines per second (or instantly if send_rate is
+#   None).
+class FakeIRC(miniirc.IRC):
+    def __init__(self, section, nick, *, send_rate=None, **kwargs):
+        super().__init__('replay.invalid', 6667, nick, auto_connect=False,
+                         **kwargs)
+        self.section     = section
+        self.send_rate   = send_rate
+        self.lines       = 0
+        self.max_depth   = 0
+        self.total_wait  = 0.0
+        self.max_wait    = 0.0
+        self._departures = collections.deque()
+        self._last_sent  = 0.0
+        self._queue_lock = threading.Lock()
+
+    def __repr__(self):
+        return f'<traffic.FakeIRC {self.section!r}>'
+
+    def connect(self):
+        self.connected = True
+
+    def disconnect(self, msg=None, *, auto_reconnect=False):
+        self.connected = None
+
+    def wait_until_disconnected(self):
+        pass
+
+    def get_server_count(self):
+        return 0
+
+    def quote(self, *msg, force=None, tags=None):
+        self.debug('>>>', *msg)
+        now = time.monotonic()
+        with self._queue_lock:
+            sent = now
+            if self.send_rate:
+                sent = max(now, self._last_sent + 1 / self.send_rate)
+            self._last_sent = sent
+
+            departures = self._departures
+            while departures and departures[0] <= now:
+                departures.popleft()
+            departures.append(sent)
+
+            self.lines += 1
+            self.max_depth = max(self.max_depth, len(departures))
+            self.total_wait += sent - now
+            self.max_wait = max(self.max_wait, sent - now)
+
+# Records when handlers are submitted, started and finished
+class _TimingExecutor:
+    def __init__(self, executor, bot):
+        self._executor = executor
+        self._bot      = bot
+
+    def submit(self, fn, *args, **kwargs):
+        if getattr(fn, '__self__', None) is not self._bot:
+            return self._executor.submit(fn, *args, **kwargs)
+
+        submitted = time.monotonic()
+        def run(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._bot.timings.append((submitted, started,
+                                          time.monotonic()))
+
+        # This lets admission control classify the message
+        run.__wrapped__ = fn
+        future = self._executor.submit(run, *args, **kwargs)
+        self._bot.futures.append(future)
+        return future
+
+# A bot that uses fake transports
+class ReplayBot(core.Bot):
+    def __init__(self, config, *, send_rate=None, debug=False):
+        self.send_rate = send_rate
+        self.timings   = []
+        self.futures   = []
+        super().__init__(config, debug=debug)
+
+    def _create_irc(self, section, cls, *args, executor=None, debug=False,
+            **kwargs):
+        # Matrix objects don't get an executor
+        if executor is None:
+            executor = self._executor
+
+        nick = self.config[section].get('nick', 'lurklite')
+        return FakeIRC(section, nick, send_rate=self.send_rate,
+                       executor=_TimingExecutor(executor, self), debug=debug)
+
+# Serve a fixed response to all HTTP requests, and redirect urllib requests
+#   (including HTTPS ones) to it.
+class _StubHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(self.server.body)))
+        self.end_headers()
+        self.wfile.write(self.server.body)
+
+    def log_message(self, *args):
+        pass
+
+class _StubRedirector(urllib.request.BaseHandler):
+    handler_order = 0
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def http_request(self, req):
+        req.full_url = self.base_url + tempcmds.web_quote(req.full_url)
+        return req
+
+    https_request = http_request
+
+def start_stub_server(body='Stub response', *, delay=0):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+    server.daemon_threads = True
+    server.body  = body.encode('utf-8')
+    server.delay = delay
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    base_url = f'http://127.0.0.1:{server.server_port}/'
+    urllib.request.install_opener(
+        urllib.request.build_opener(_StubRedirector(base_url)))
+    return server
+
+# Feed events into a bot, speed is a multiple of real time (or 0 to replay
+#   events as fast as possible). Returns the number of events replayed and
+#   skipped.
+def replay(bot, events, *, speed=1.0):
+    ircs = {prefs['network']: irc for irc, prefs in bot._prefs.items()}
+    replayed = skipped = 0
+    start = first = None
+    for timestamp, network, event, hostmask, args in events:
+        irc = ircs.get(network)
+        if irc is None:
+            skipped += 1
+            continue
+
+        if start is None:
+            start, first = time.monotonic(), timestamp
+        elif speed:
+            delay = start + (timestamp - first) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        # This uses miniirc internals so that handlers are launched exactly
+        #   as they would be with incoming messages.
+        irc._handle(event, tuple(hostmask), {}, args)
+        replayed += 1
+
+    return replayed, skipped
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+def _format_ms(values):
+    values = sorted(values)
+    mean = sum(values) / len(values) if values else 0.0
+    return ', '.join(f'{name} {value * 1000:.1f}ms' for name, value in (
+        ('mean', mean), ('p50', _percentile(values, 50)),
+        ('p90', _percentile(values, 90)), ('p99', _percentile(values, 99)),
+        ('max', values[-1] if values else 0.0)))
+
+def report(bot, replayed, skipped, elapsed):
+    print(f'Replayed {replayed} event(s) ({skipped} skipped) in '
+          f'{elapsed:.2f}s ({replayed / (elapsed or 1):.1f} events/s).')
+    print('Handler latency:', _format_ms([end - submitted
+        for submitted, _, end in bot.timings]))
+    print('Queue delay:    ', _format_ms([started - submitted
+        for submitted, started, _ in bot.timings]))
+
+    stats = bot._executor.stats
+    print(f'Shed {stats["shed_queue"]} event(s) because the queue was full '
+          f'and {stats["shed_stale"]} stale event(s), coalesced '
+          f'{stats["coalesced"]} event(s).')
+
+    for irc in bot._prefs:
+        if isinstance(irc, FakeIRC):
+            mean = irc.total_wait / irc.lines if irc.lines else 0.0
+            print(f'Output to {irc.section!r}: {irc.lines} line(s), max send '
+                  f'queue depth {irc.max_depth}, send wait mean '
+                  f'{mean * 1000:.1f}ms, max {irc.max_wait * 1000:.1f}ms.')
+
+# The replay CLI
+def main():
+    parser = argparse.ArgumentParser(prog='python3 -m lurklite.traffic',
+        description='Replay recorded traffic against lurklite.')
+    parser.add_argument('config_file', help='The config file to use.')
+    parser.add_argument('recording', help='The recorded traffic.')
+    parser.add_argument('--speed', type=float, default=1.0,
+        help='A multiple of real time to replay events at, 0 replays events '
+             'as fast as possible.')
+    parser.add_argument('--send-rate', type=float,
+        help='Simulate a send queue drained at this many lines per second.')
+    parser.add_argument('--http-body', default='Stub response',
+        help='The response to send to URL tempcmds.')
+    parser.add_argument('--http-delay', type=float, default=0,
+        help='The delay (in seconds) before responding to URL tempcmds.')
+    parser.add_argument('--verbose', '--debug', action='store_true',
+        help='Enable verbose/debugging mode.')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config_file)
+    if 'core' in config:
+        config.remove_option('core', 'record_traffic')
+
+    # Don't write to the real audit log or replicate with live peers
+    for section in 'audit', 'replication':
+        config.remove_section(section)
+
+    # Don't modify the real command database
+    tmpdir = tempfile.mkdtemp(prefix='lurklite-replay-')
+    try:
+        if 'core' in config and 'command_db' in config['core']:
+            command_db = os.path.join(tmpdir, 'commands.db')
+            if os.path.exists(config['core']['command_db']):
+                shutil.copyfile(config['core']['command_db'], command_db)
+            if os.path.isdir(config['core']['command_db'] + '.d'):
+                shutil.copytree(config['core']['command_db'] + '.d',
+                                command_db + '.d')
+            config['core']['command_db'] = command_db
+
+        start_stub_server(args.http_body, delay=args.http_delay)
+        bot = ReplayBot(config, send_rate=args.send_rate,
+                        debug=args.verbose)
+
+        # Don't let recorded admin commands stop the replay.
+        import lurklite.static_cmds as static_cmds
+        for cmd in ('reboot', 'die', 'shutdown'):
+            static_cmds.commands.pop(cmd, None)
+
+        start = time.monotonic()
+        replayed, skipped = replay(bot, read_recording(args.recording),
+                                   speed=args.speed)
+        concurrent.futures.wait(bot.futures)
+        report(bot, replayed, skipped, time.monotonic() - start)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+#
+# Admission control tests
+#
+
+import concurrent.futures, contextlib, io, threading, time, unittest
+import lurklite.admission as admission
+
+class TestAdmissionExecutor(unittest.TestCase):
+    # Bursts submitted after the executor has been idle should still run in
+    #   parallel rather than all waking the same idle worker.
+    def test_burst_runs_in_parallel(self):
+        executor = admission.AdmissionExecutor(32)
+        executor.submit(lambda : None).result()
+        time.sleep(0.1)
+
+        lock = threading.Lock()
+        running = peak = 0
+        def job():
+            nonlocal running, peak
+            with lock:
+                running += 1
+                peak = max(peak, running)
+            time.sleep(0.3)
+            with lock:
+                running -= 1
+
+        start = time.monotonic()
+        futures = [executor.submit(job) for _ in range(20)]
+        concurrent.futures.wait(futures)
+        self.assertEqual(peak, 20)
+        self.assertLess(time.monotonic() - start, 2)
+
+    # Low priority bursts shouldn't be shed when the executor has enough
+    #   workers to start them straight away.
+    def test_burst_not_shed(self):
+        executor = admission.AdmissionExecutor(32, max_queue=8,
+            classify=lambda fn, args : (admission.LOW, None))
+        executor.submit(lambda : None).result()
+        time.sleep(0.1)
+
+        futures = [executor.submit(time.sleep, 0.2) for _ in range(12)]
+        concurrent.futures.wait(futures)
+        self.assertFalse(any(future.cancelled() for future in futures))
+        self.assertEqual(executor.stats['shed_queue'], 0)
+
+    # Errors from classify() shouldn't be raised into receive threads.
+    def test_classify_error(self):
+        def classify(fn, args):
+            raise AttributeError('test')
+
+        executor = admission.AdmissionExecutor(classify=classify)
+        with contextlib.redirect_stdout(io.StringIO()), \
+                contextlib.redirect_stderr(io.StringIO()):
+            future = executor.submit(lambda : 'result')
+        self.assertEqual(future.result(timeout=5), 'result')
+
+if __name__ == '__main__':
+    unittest.main()